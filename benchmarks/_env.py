@@ -0,0 +1,25 @@
+# only for benchmarks, don't import in prod code
+# run them from the repo root, e.g. `python -m benchmarks.bench_safe_io`
+# fills in dummy values for the settings `server.constants` insists on
+# so the storage/caching layers can be imported without a real deployment
+from os import environ
+
+from set_env import setup_env
+
+setup_env()
+
+_REQUIRED = (
+    "JWT_SIGNING_KEY",
+    "FLASK_SECRET",
+    "REFRESH_TOKEN_SALT",
+    "BACKEND_WEBHOOK_URL",
+    "MAIL_USER",
+    "MAIL_PASS",
+    "REMOTE_LOG_DB_KEY",
+    "LOG_SERVER_ENDPOINT",
+    "DEALER_KEY",
+)
+for k in _REQUIRED:
+    environ.setdefault(k, "benchmark")
+if not environ.get("DATABASE_URL"):
+    environ.setdefault("DB_URL", "postgresql://localhost/halocrypt")
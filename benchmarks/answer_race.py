@@ -0,0 +1,60 @@
+"""Fires parallel correct submissions for the same level at a running server
+
+every submission carries the right answer for the user's current level,
+exactly one of them may be counted and the user must advance by one level.
+floodgate rate limits still apply, raise FG_REQUEST_COUNT on the target server
+
+usage:
+    python -m benchmarks.answer_race <base-url> <event> <user> <password> <answer> [parallel]
+"""
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+
+import requests
+
+_HEADERS = {"x-access-key": environ.get("DEALER_KEY", "")}
+
+
+def login(base, user, password):
+    resp = requests.post(
+        f"{base}/accounts/login",
+        json={"user": user, "password": password},
+        headers=_HEADERS,
+    )
+    resp.raise_for_status()
+    return {**_HEADERS, "Authorization": f"Bearer {resp.headers['x-access-token']}"}
+
+
+def current_level(base, headers):
+    resp = requests.get(f"{base}/accounts/me/", headers=headers)
+    return resp.json()["data"]["user_data"]["level"]
+
+
+def main(base, event, user, password, answer, parallel=16):
+    parallel = int(parallel)
+    headers = login(base, user, password)
+    before = current_level(base, headers)
+
+    def submit(_):
+        resp = requests.post(
+            f"{base}/play/{event}/answer/", json={"answer": answer}, headers=headers
+        )
+        return resp.json().get("data", {}).get("is_correct")
+
+    with ThreadPoolExecutor(parallel) as pool:
+        results = list(pool.map(submit, range(parallel)))
+    after = current_level(base, headers)
+    counted = results.count(True)
+    print(f"submissions={parallel} counted={counted} level {before} -> {after}")
+    if counted != 1 or after != before + 1:
+        print("FAIL: a solve was lost or counted more than once")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 6:
+        print(__doc__)
+        sys.exit(2)
+    main(*sys.argv[1:])
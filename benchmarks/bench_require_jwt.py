@@ -0,0 +1,46 @@
+"""Per-request overhead of `require_jwt` with and without the verified-token cache
+
+usage:
+    python -m benchmarks.bench_require_jwt [rounds]
+"""
+import benchmarks._env  # noqa: F401 pylint: disable=unused-import
+
+import sys
+from time import perf_counter
+
+from server.app_init import app
+from server.auth_token import issue_access_token, require_jwt, verified_tokens
+from server.danger import create_token
+
+
+@require_jwt()
+def endpoint(creds=None):
+    return creds.user
+
+
+def timed(rounds, before_each=None):
+    start = perf_counter()
+    for _ in range(rounds):
+        before_each and before_each()
+        endpoint()
+    return (perf_counter() - start) / rounds * 1e6
+
+
+def main(rounds=20000):
+    rounds = int(rounds)
+    token = create_token(issue_access_token("someone", False))
+    headers = {"Authorization": f"Bearer {token}"}
+    with app.test_request_context(headers=headers):
+        baseline = timed(rounds, verified_tokens.clear)
+        clear_only = perf_counter()
+        for _ in range(rounds):
+            verified_tokens.clear()
+        clear_only = (perf_counter() - clear_only) / rounds * 1e6
+        cached = timed(rounds)
+    print(f"{rounds} calls")
+    print(f"signature check on every call  {baseline - clear_only:8.2f} us/request")
+    print(f"verified-token cache           {cached:8.2f} us/request")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
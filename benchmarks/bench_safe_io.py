@@ -0,0 +1,147 @@
+"""Compares the atomic-replace storage layer with the old lockfile protocol
+
+counts the filesystem syscalls ( open/stat/mkdir/unlink/replace, the matching
+read and close calls are not counted ) and the latency of a single cache hit
+( meta read + body read ) and a single cache write for both implementations
+"""
+import benchmarks._env  # noqa: F401 pylint: disable=unused-import
+
+import os
+import sys
+from os.path import basename
+from pathlib import Path
+from time import perf_counter
+
+from server.constants import CACHE_DIR
+from server import safe_io
+
+ROUNDS = 5000
+BODY = b'{"data": [' + b'{"user": "someone", "points": 100}, ' * 2000 + b"{}]}"
+_WATCHED = ("stat", "lstat", "mkdir", "unlink", "replace", "rename")
+
+# ==================================================================
+#      the lockfile protocol as it was before the atomic rewrite
+_LOCKFILE_SUFFIX = "~#.lock"
+
+
+def _lockfile_path(name):
+    return Path(CACHE_DIR, f"{basename(name)}{_LOCKFILE_SUFFIX}")
+
+
+def _legacy_mkdir():
+    Path(CACHE_DIR).mkdir(exist_ok=True)
+
+
+def _legacy_remove(name):
+    try:
+        Path(name).unlink()
+    except:
+        pass
+
+
+def _legacy_create_lockfile(name):
+    _legacy_mkdir()
+    open(_lockfile_path(name), "w").close()
+
+
+def _legacy_close_lockfile(name):
+    _legacy_mkdir()
+    _legacy_remove(_lockfile_path(name))
+
+
+def legacy_read(filename: Path, mode="r"):
+    _legacy_mkdir()
+    if not filename.exists():
+        return None
+    elif _lockfile_path(filename).exists():
+        return None
+    _legacy_create_lockfile(filename)
+    dx = filename.read_text().strip() if mode == "r" else filename.read_bytes()
+    _legacy_close_lockfile(filename)
+    return dx or None
+
+
+def legacy_write(filename: Path, data, mode="w"):
+    _legacy_mkdir()
+    if _lockfile_path(filename).exists():
+        return None
+    _legacy_create_lockfile(filename)
+    filename.write_text(data) if mode == "w" else filename.write_bytes(data)
+    _legacy_close_lockfile(filename)
+
+
+# ==================================================================
+
+
+class SyscallCounter:
+    def __init__(self):
+        self.count = 0
+        self.enabled = False
+        sys.addaudithook(self._audit)
+        for name in _WATCHED:
+            setattr(os, name, self._wrap(getattr(os, name)))
+
+    def _audit(self, event, _):
+        if self.enabled and event == "open":
+            self.count += 1
+
+    def _wrap(self, fn):
+        def run(*args, **kwargs):
+            if self.enabled:
+                self.count += 1
+            return fn(*args, **kwargs)
+
+        return run
+
+    def measure(self, fn):
+        self.count = 0
+        self.enabled = True
+        fn()
+        self.enabled = False
+        return self.count
+
+
+def hit(read, meta, data):
+    def run():
+        read(meta)
+        read(data, mode="rb")
+
+    return run
+
+
+def write(write_fn, meta, data):
+    def run():
+        write_fn(data, BODY, mode="wb")
+        write_fn(meta, b'{"time_stamp": 0, "data": "x"}', mode="wb")
+
+    return run
+
+
+def timed(fn):
+    start = perf_counter()
+    for _ in range(ROUNDS):
+        fn()
+    return (perf_counter() - start) / ROUNDS * 1e6
+
+
+def main():
+    counter = SyscallCounter()
+    meta = Path(CACHE_DIR, "bench-io.meta.json")
+    data = Path(CACHE_DIR, "bench-io.cache.json")
+    impls = (
+        ("lockfile", legacy_read, legacy_write),
+        ("atomic", safe_io.open_and_read, safe_io.open_and_write),
+    )
+    print(f"{'impl':<10}{'op':<7}{'syscalls':>10}{'us/op':>10}")
+    for name, read_fn, write_fn in impls:
+        w = write(write_fn, meta, data)
+        r = hit(read_fn, meta, data)
+        for op, fn in (("write", w), ("hit", r)):
+            calls = counter.measure(fn)
+            print(f"{name:<10}{op:<7}{calls:>10}{timed(fn):>10.1f}")
+    _legacy_remove(meta)
+    _legacy_remove(data)
+
+
+if __name__ == "__main__":
+    main()
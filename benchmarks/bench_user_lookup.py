@@ -0,0 +1,67 @@
+"""Case-insensitive username lookup latency with 50k users
+
+builds a scratch copy of the `user` table with 50k rows in the database from
+DATABASE_URL ( or DB_URL ) and times `lower(user) = lower(:user)` lookups
+without and with the `lower(user)` expression index. the scratch table is
+dropped afterwards, the real user table is never touched
+
+usage:
+    python -m benchmarks.bench_user_lookup [rows] [lookups]
+"""
+import benchmarks._env  # noqa: F401 pylint: disable=unused-import
+
+import sys
+from random import randrange
+from time import perf_counter
+
+from sqlalchemy import create_engine, text
+
+from server.constants import DATABASE_URL
+
+TABLE = "bench_user_lookup"
+
+
+def timed_lookups(conn, rows, lookups):
+    query = text(f'SELECT * FROM {TABLE} WHERE lower("user") = lower(:u) LIMIT 1')
+    start = perf_counter()
+    for _ in range(lookups):
+        conn.execute(query, {"u": f"User{randrange(rows)}"}).first()
+    return (perf_counter() - start) / lookups * 1000
+
+
+def main(rows=50_000, lookups=500):
+    rows, lookups = int(rows), int(lookups)
+    engine = create_engine(DATABASE_URL)
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+        conn.execute(
+            text(
+                f'CREATE TABLE {TABLE} ("user" varchar(35) UNIQUE NOT NULL,'
+                " name varchar(100), points integer, level integer)"
+            )
+        )
+        conn.execute(
+            text(
+                f'INSERT INTO {TABLE} ("user", name, points, level) '
+                "SELECT 'user' || i, 'name ' || i, i % 500, i % 50 "
+                "FROM generate_series(0, :n - 1) AS i"
+            ),
+            {"n": rows},
+        )
+        conn.execute(text(f"ANALYZE {TABLE}"))
+    try:
+        with engine.connect() as conn:
+            before = timed_lookups(conn, rows, lookups)
+            conn.execute(text(f'CREATE INDEX ON {TABLE} (lower("user"))'))
+            conn.execute(text(f"ANALYZE {TABLE}"))
+            after = timed_lookups(conn, rows, lookups)
+        print(f"{rows} users, {lookups} lookups")
+        print(f"sequential scan     {before:8.3f} ms/lookup")
+        print(f"expression index    {after:8.3f} ms/lookup")
+    finally:
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,76 @@
+"""Round trip of cache entries through pack, unpack and read_header
+
+packs entries with bodies of every size up to `max-size` bytes ( with and
+without tags and compressed variants ), unpacks them again and reads their
+header from disk the way the janitor does, then caches a small body through
+the decorator path and checks that a janitor sweep leaves the fresh entry alone.
+exits with status 1 on the first mismatch
+
+usage:
+    python -m benchmarks.cache_entry_roundtrip [max-size]
+"""
+import benchmarks._env  # noqa: F401 pylint: disable=unused-import
+
+import sys
+from pathlib import Path
+from tempfile import mkdtemp
+from time import time
+
+from server import cache_entry, janitor
+from server.constants import CACHE_DIR
+from server.response_caching import (
+    ENTRY_SUFFIX,
+    cache_data,
+    invalidate_keys,
+    take_stamp,
+)
+
+KEY = "roundtrip-check"
+FIELDS = ("flags", "time_stamp", "timeout", "stale_ttl", "generation", "etag")
+
+
+def check(ok, what):
+    if not ok:
+        print("mismatch:", what)
+        sys.exit(1)
+
+
+def entries(max_size):
+    for size in range(max_size + 1):
+        body = b"x" * size
+        for tags in ({}, {"leaderboard:main": 3}):
+            for bodies in ({"identity": body}, {"identity": body, "gzip": body[:3]}):
+                etag = "ab" * 16 if size else None
+                yield cache_entry.StoredEntry(
+                    1, time(), 60.0, 5.0, 7, etag, "application/json", tags, bodies
+                )
+
+
+def main(max_size=64):
+    scratch = Path(mkdtemp(), "entry")
+    count = 0
+    for entry in entries(int(max_size)):
+        packed = cache_entry.pack(entry)
+        unpacked = cache_entry.unpack(packed)
+        scratch.write_bytes(packed)
+        header = cache_entry.read_header(scratch)
+        for name in FIELDS + ("content_type", "tags"):
+            check(getattr(unpacked, name) == getattr(entry, name), f"unpack {name}")
+            check(getattr(header, name) == getattr(entry, name), f"header {name}")
+        # empty bodies aren't stored
+        bodies = {k: v for k, v in entry.bodies.items() if v}
+        check({k: bytes(v) for k, v in unpacked.bodies.items()} == bodies, "bodies")
+        count += 1
+    scratch.unlink()
+
+    # the smallest bodies the app caches ( {"data": []} and {"data": {}} )
+    for data in ([], {}):
+        cache_data(KEY, data, take_stamp(KEY, ()), timeout=60)
+        janitor.sweep()
+        check(Path(CACHE_DIR, KEY + ENTRY_SUFFIX).exists(), f"swept fresh {data!r}")
+        invalidate_keys([KEY], broadcast=False)
+    print(f"{count} entries round tripped, small bodies survive a sweep")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,70 @@
+"""Cache hits per second for a single worker thread
+
+caches a leaderboard sized json body under a scratch key and calls the cached
+function in a loop for `seconds` seconds per case:
+    memory      hits served from the per-worker memory tier
+    memory-json the same with json_cache=True
+    disk        the memory tier disabled, every hit reads the entry from CACHE_DIR
+    disk-json   the same with json_cache=True ( the body is parsed as well )
+
+usage:
+    python -m benchmarks.cache_hits [seconds] [rows]
+"""
+import benchmarks._env  # noqa: F401 pylint: disable=unused-import
+
+import sys
+from contextlib import redirect_stdout
+from os import devnull
+from time import perf_counter
+
+from flask import Flask
+
+from server import response_caching
+from server.memory_cache import MemoryCache
+from server.response_caching import cache, invalidate_keys
+
+KEY = "bench-cache-hits"
+
+
+def rate(func, seconds):
+    # the "Cache hit" log lines go to /dev/null
+    with open(devnull, "w") as out, redirect_stdout(out):
+        func()
+        hits = 0
+        start = perf_counter()
+        while perf_counter() - start < seconds:
+            for _ in range(100):
+                func()
+            hits += 100
+    return hits / (perf_counter() - start)
+
+
+def main(seconds=3, rows=2000):
+    seconds, rows = float(seconds), int(rows)
+    board = [
+        {"user": f"user{i}", "name": f"Name {i}", "points": rows - i, "level": i % 50}
+        for i in range(rows)
+    ]
+
+    @cache(KEY)
+    def response():
+        return board
+
+    @cache(f"{KEY}-json", json_cache=True)
+    def parsed():
+        return board
+
+    memory_tier = response_caching.memory_tier
+    app = Flask(__name__)
+    with app.test_request_context(headers={"Accept-Encoding": "gzip"}):
+        print(f"memory      {rate(response, seconds):10.0f} hits/s")
+        print(f"memory-json {rate(parsed, seconds):10.0f} hits/s")
+        response_caching.memory_tier = MemoryCache(0, 0, 0)
+        print(f"disk        {rate(response, seconds):10.0f} hits/s")
+        print(f"disk-json   {rate(parsed, seconds):10.0f} hits/s")
+        response_caching.memory_tier = memory_tier
+        invalidate_keys([KEY, f"{KEY}-json"], broadcast=False)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,82 @@
+"""Startup time and worker memory with and without `preload_app`
+
+starts gunicorn with gunicorn.conf.py twice ( PRELOAD_APP unset and set ) on a
+scratch socket, waits until every worker logged that it is ready and then
+reports the time that took along with the rss/pss of the master and each
+worker. the warm-up needs the database from DATABASE_URL ( or DB_URL ),
+without one it fails quickly and only the import cost is measured
+
+usage:
+    python -m benchmarks.gunicorn_startup [workers]
+"""
+import benchmarks._env  # noqa: F401 pylint: disable=unused-import
+
+import re
+import sys
+from os import environ
+from subprocess import PIPE, STDOUT, Popen
+from time import perf_counter
+
+from server.metrics import process_memory
+
+SOCKET = "unix:/tmp/bench-gunicorn-startup.sock"
+READY = re.compile(r"worker (\d+) ready ([\d.]+)s after fork")
+
+
+def _mib(mem: dict, key: str) -> float:
+    return mem.get(key, 0) / 2**20
+
+
+def run(preload: bool, workers: int) -> dict:
+    env = dict(environ)
+    env.pop("PRELOAD_APP", None)
+    if preload:
+        env["PRELOAD_APP"] = "1"
+    cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py"]
+    cmd += ["--bind", SOCKET, "--workers", str(workers), "_core:app"]
+    start = perf_counter()
+    proc = Popen(cmd, env=env, stdout=PIPE, stderr=STDOUT, text=True)
+    ready = {}
+    try:
+        for line in proc.stdout:
+            match = READY.search(line)
+            if match:
+                ready[int(match[1])] = float(match[2])
+            if len(ready) == workers:
+                break
+        else:
+            raise RuntimeError("gunicorn exited before every worker was ready")
+        elapsed = perf_counter() - start
+        memory = {pid: process_memory(pid) for pid in ready}
+        master = process_memory(proc.pid)
+    finally:
+        proc.terminate()
+        proc.wait()
+    return {"elapsed": elapsed, "ready": ready, "memory": memory, "master": master}
+
+
+def report(name: str, res: dict):
+    print(f"{name}: all workers ready after {res['elapsed']:.2f}s")
+    print(
+        f"  master     rss {_mib(res['master'], 'rss'):7.1f}MiB"
+        f" pss {_mib(res['master'], 'pss'):7.1f}MiB"
+    )
+    for pid, mem in res["memory"].items():
+        print(
+            f"  worker {pid:<6} rss {_mib(mem, 'rss'):7.1f}MiB"
+            f" pss {_mib(mem, 'pss'):7.1f}MiB"
+            f"  ready {res['ready'][pid]:.2f}s after fork"
+        )
+    total = sum(mem.get("pss", 0) for mem in res["memory"].values())
+    total += res["master"].get("pss", 0)
+    print(f"  total pss {total / 2**20:.1f}MiB")
+
+
+def main(workers=3):
+    workers = int(workers)
+    report("preload_app off", run(False, workers))
+    report("preload_app on ", run(True, workers))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,118 @@
+"""Cross-node invalidation with several local app instances
+
+starts `nodes` gunicorn instances on consecutive ports, every one with its own
+CACHE_DIR and the others as INVALIDATION_PEERS, and invalidates a key through
+the first node. reports how long it took until the key's generation was bumped
+everywhere, then repeats that with the last node stopped and measures how long
+it takes to catch up once it is back
+
+usage:
+    python -m benchmarks.invalidation_fanout [nodes] [first-port]
+"""
+import benchmarks._env  # noqa: F401 pylint: disable=unused-import
+
+import sys
+from os import environ
+from pathlib import Path
+from shutil import rmtree
+from subprocess import DEVNULL, Popen
+from tempfile import mkdtemp
+from time import perf_counter, sleep
+
+import requests
+
+from server import generations
+
+KEY = "fanout-check"
+HEADERS = {"x-access-key": environ.get("DEALER_KEY", "")}
+
+
+def start(port, cache_dir, peers):
+    env = {
+        **environ,
+        "CACHE_DIR": cache_dir,
+        "INVALIDATION_PEERS": ",".join(peers),
+        "INVALIDATION_SECRET": "fanout-benchmark",
+        "FG_REQUEST_COUNT": "100000",
+    }
+    cmd = [sys.executable, "-m", "gunicorn", "-w", "2", "--threads", "4"]
+    cmd += ["-b", f"127.0.0.1:{port}", "_core:app"]
+    return Popen(cmd, env=env, stdout=DEVNULL, stderr=DEVNULL)
+
+
+def wait_until_up(url):
+    for _ in range(200):
+        try:
+            requests.get(f"{url}/robots.txt", timeout=1)
+            return
+        except requests.RequestException:
+            sleep(0.1)
+    raise RuntimeError(f"{url} did not start")
+
+
+def generation(cache_dir):
+    # the key's generation in the node's table ( see server/generations.py )
+    offset = generations._offset(KEY)  # pylint: disable=protected-access
+    try:
+        with open(Path(cache_dir, generations.FILE_NAME), "rb") as f:
+            f.seek(offset)
+            return int.from_bytes(f.read(8), sys.byteorder)
+    except FileNotFoundError:
+        return 0
+
+
+def wait_until_invalidated(dirs, before, timeout=60):
+    start = perf_counter()
+    while any(generation(d) <= before[d] for d in dirs):
+        if perf_counter() - start > timeout:
+            raise RuntimeError("invalidation did not arrive")
+        sleep(0.01)
+    return perf_counter() - start
+
+
+def invalidate(url):
+    resp = requests.post(
+        f"{url}/admin/-/invalidate/", json={"keys": [KEY]}, headers=HEADERS
+    )
+    resp.raise_for_status()
+
+
+def main(nodes=3, first_port=5201):
+    nodes, first_port = int(nodes), int(first_port)
+    urls = [f"http://127.0.0.1:{first_port + i}" for i in range(nodes)]
+    dirs = [mkdtemp(prefix=f"node{i}-") for i in range(nodes)]
+
+    def launch(i):
+        return start(first_port + i, dirs[i], [u for u in urls if u != urls[i]])
+
+    procs = [launch(i) for i in range(nodes)]
+    try:
+        for url in urls:
+            wait_until_up(url)
+
+        before = {d: generation(d) for d in dirs}
+        invalidate(urls[0])
+        took = wait_until_invalidated(dirs, before)
+        print(f"all {nodes} nodes invalidated after {took:.3f}s")
+
+        procs[-1].terminate()
+        procs[-1].wait()
+        before = {d: generation(d) for d in dirs}
+        invalidate(urls[0])
+        took = wait_until_invalidated(dirs[:-1], before)
+        print(f"last node down: the other nodes invalidated after {took:.3f}s")
+        sleep(2)
+        procs[-1] = launch(nodes - 1)
+        wait_until_up(urls[-1])
+        took = wait_until_invalidated(dirs[-1:], before)
+        print(f"last node back up: caught up {took:.3f}s after it started serving")
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+        for d in dirs:
+            rmtree(d, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
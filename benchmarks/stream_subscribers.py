@@ -0,0 +1,111 @@
+"""Idle server-sent event subscribers and update fan-out
+
+starts the stream process ( server/stream.py ) on a scratch tcp port, opens
+`subscribers` idle streams to one event and reports the stream process memory,
+then publishes `updates` leaderboard deltas the way the workers do ( live.py )
+and measures how long it takes until every subscriber received each of them
+
+usage:
+    python -m benchmarks.stream_subscribers [subscribers] [updates]
+"""
+import benchmarks._env  # noqa: F401 pylint: disable=unused-import
+
+import asyncio
+import resource
+import sys
+from os import environ
+from subprocess import Popen
+from time import perf_counter
+
+PORT = 5099
+environ["STREAM_BIND"] = f"127.0.0.1:{PORT}"
+environ["STREAM_EVENTS_SOCKET"] = "/tmp/bench-stream-events.socket"
+
+# pylint: disable=wrong-import-position
+from server import live
+from server.constants import EVENT_NAMES
+from server.metrics import process_memory
+
+EVENT = EVENT_NAMES[-1]
+REQUEST = f"GET /play/{EVENT}/stream/ HTTP/1.1\r\nHost: bench\r\n\r\n".encode()
+
+
+async def subscribe():
+    reader, writer = await asyncio.open_connection("127.0.0.1", PORT)
+    writer.write(REQUEST)
+    await reader.readuntil(b"\r\n\r\n")
+    # `retry:` line
+    await reader.readuntil(b"\n\n")
+    return reader, writer
+
+
+async def wait_for_update(reader):
+    while True:
+        chunk = await reader.readuntil(b"\n\n")
+        if chunk.startswith(b"id:"):
+            return
+
+
+async def wait_until_listening(proc):
+    for _ in range(100):
+        if proc.poll() is not None:
+            raise RuntimeError("stream process exited")
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", PORT)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("stream process did not start")
+
+
+async def run(proc, subscribers, updates):
+    await wait_until_listening(proc)
+    idle = process_memory(proc.pid)
+
+    start = perf_counter()
+    conns = []
+    for i in range(0, subscribers, 500):
+        batch = min(500, subscribers - i)
+        conns += await asyncio.gather(*(subscribe() for _ in range(batch)))
+    print(f"{subscribers} subscribers connected in {perf_counter() - start:.2f}s")
+
+    await asyncio.sleep(1)
+    mem = process_memory(proc.pid)
+    for k in mem:
+        print(
+            f"stream process {k}: {idle[k] / 2**20:.1f}MiB idle, "
+            f"{mem[k] / 2**20:.1f}MiB with subscribers "
+            f"( {(mem[k] - idle[k]) / subscribers / 1024:.1f}KiB each )"
+        )
+
+    latencies = []
+    for n in range(updates):
+        waiting = [asyncio.ensure_future(wait_for_update(r)) for r, _ in conns]
+        row = {"user": f"bench{n}", "name": "bench", "points": n, "level": n}
+        start = perf_counter()
+        live.publish(EVENT, live.LEADERBOARD, {"op": "upsert", "row": row, "rank": 1})
+        await asyncio.gather(*waiting)
+        latencies.append(perf_counter() - start)
+    latencies.sort()
+    print(
+        f"update reached all subscribers in {latencies[len(latencies) // 2] * 1000:.1f}ms"
+        f" ( median of {updates} ), worst {latencies[-1] * 1000:.1f}ms"
+    )
+    for _, writer in conns:
+        writer.close()
+
+
+def main(subscribers=5000, updates=20):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    proc = Popen([sys.executable, "-m", "server.stream"])
+    try:
+        asyncio.run(run(proc, int(subscribers), int(updates)))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -1,17 +1,35 @@
 import subprocess
 import os
+import time
 
 
 p = os.environ.get("PASSPHRASE")
 if p:
     subprocess.Popen(["bash", "./decrypt.sh", p]).wait()
 
+# import and warm the app once in the master and fork the workers from it,
+# they share its memory copy-on-write and a recycled worker skips the imports
+preload_app = os.environ.get("PRELOAD_APP") is not None
+# the app sizes its password hashing queue by it ( see server/constants.py )
+threads = int(os.environ.get("WORKER_THREADS", 4))
+
+_started_at = time.time()
+
 del os
 del subprocess
 del p
 
 
-def when_ready(server):
+def _warm_up():
+    # fill the caches ( within WARM_UP_BUDGET seconds ) before taking traffic
+    from server.app_init import app
+    from server import warm_up
+
+    with app.app_context():
+        warm_up.run()
+
+
+def _mark_initialized():
     # touch app-initialized when ready
     try:
         open("/tmp/app-initialized", "w").close()
@@ -19,9 +37,102 @@ def when_ready(server):
         pass
 
 
+def _dispose_engine():
+    # drop every pooled connection, the pool is refilled lazily by whoever
+    # uses it next. a connection must never be shared by two processes
+    from server.app_init import app
+    from server.models import db
+
+    with app.app_context():
+        db.engine.dispose()
+
+
+def _memory() -> str:
+    from server.metrics import process_memory
+
+    mem = process_memory()
+    return " ".join(f"{k} {v / 2**20:.1f}MiB" for k, v in mem.items())
+
+
+def on_starting(server):
+    # left over from a previous run, nginx must wait for this one to warm up
+    from os import remove
+
+    try:
+        remove("/tmp/app-initialized")
+    except OSError:
+        pass
+
+
+def _ensure_stream(server):
+    # the server-sent events process ( server/stream.py ) lives next to the
+    # workers, started here and restarted whenever the master forks a worker
+    # and finds it gone
+    from subprocess import Popen
+    import sys
+
+    proc = getattr(server, "stream_process", None)
+    if proc is not None and proc.poll() is None:
+        return
+    if proc is not None:
+        server.log.warning("stream process exited with %s, restarting", proc.returncode)
+    server.stream_process = Popen([sys.executable, "-m", "server.stream"])
+
+
+def when_ready(server):
+    _ensure_stream(server)
+    if preload_app:
+        # the app was imported before this hook runs
+        from server import gc_policy
+
+        _warm_up()
+        _dispose_engine()
+        gc_policy.freeze()
+        server.log.info(
+            "app preloaded in %.2fs, master %s",
+            time.time() - _started_at,
+            _memory(),
+        )
+        _mark_initialized()
+
+
+def pre_fork(server, worker):
+    _ensure_stream(server)
+    if preload_app:
+        _dispose_engine()
+    worker.forked_at = time.time()
+
+
+def post_fork(server, worker):
+    if preload_app:
+        # the engine object is inherited, make sure it starts a pool of its own
+        _dispose_engine()
+
+
+def post_worker_init(worker):
+    # the app is already imported at this point
+    if not preload_app:
+        _warm_up()
+        # whichever worker gets here first, the others don't accept
+        # connections until they are warm as well
+        _mark_initialized()
+    worker.log.info(
+        "worker %s ready %.2fs after fork ( preload_app=%s ), %s",
+        worker.pid,
+        time.time() - worker.forked_at,
+        preload_app,
+        _memory(),
+    )
+
+
+def on_exit(server):
+    proc = getattr(server, "stream_process", None)
+    if proc is not None:
+        proc.terminate()
+
+
 bind = "unix:///tmp/nginx.socket"
 workers = 3
-threads = 4
 max_requests = 1200
 max_requests_jitter = 10
 timeout = 500
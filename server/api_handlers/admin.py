@@ -1,3 +1,4 @@
+from http import HTTPStatus
 from server.api_handlers.common import (
     add_to_db,
     delete_from_db,
@@ -12,10 +13,20 @@ from server.api_handlers.common import (
     send_admin_action_webhook,
 )
 from server.api_handlers.cred_manager import CredManager
+from server import cache_tags, invalidation_bus
+from server import leaderboard as ranking
+from server import live
+from server import metrics
 from server.auth_token import require_jwt
 from server.constants import REMOTE_LOG_DB_KEY
 from server.models.question import Question
-from server.response_caching import cache, invalidate, invalidate_keys
+from server.cache_tags import DETAILS, EVENTS, LEADERBOARD, QUESTIONS, for_event, of
+from server.response_caching import (
+    cache,
+    invalidate_keys,
+    invalidate_tagged,
+    invalidate_tags,
+)
 from server.util import AppException, ParsedRequest, js_time
 from sqlalchemy.orm.attributes import flag_modified
 
@@ -41,7 +52,8 @@ def disqualify(req: ParsedRequest, user, *, creds: CredManager = CredManager):
     js = user_data.as_json
     send_admin_action_webhook([f"{user} was disqualified by {creds.user}"])
     save_to_db()
-    return invalidate(f"{user_data.event}-leaderboard", js)
+    ranking.record(js)
+    return invalidate_tagged(of(user_data.event, LEADERBOARD), js, stale=True)
 
 
 @require_jwt(admin_mode=True)
@@ -51,8 +63,9 @@ def requalify(user, creds=CredManager):
     user_data.disqualification_reason = None
     js = user_data.as_json
     save_to_db()
+    ranking.record(js)
     send_admin_action_webhook([f"{user} was requalified by {creds.user}"])
-    return invalidate(f"{user_data.event}-leaderboard", js)
+    return invalidate_tagged(of(user_data.event, LEADERBOARD), js, stale=True)
 
 
 @require_jwt(admin_mode=True)
@@ -60,9 +73,11 @@ def delete(user, creds: CredManager = CredManager):
     user_data = get_user_by_id(user)
     if user_data.is_admin:
         raise AppException("Cannot delete an admin account!")
+    event, name = user_data.event, user_data.user
     delete_from_db(user_data)
+    ranking.record_removal(event, name)
     send_admin_action_webhook([f"{user} was deleted by {creds.user}"])
-    return {"success": True}
+    return invalidate_tagged(of(event, LEADERBOARD), {"success": True}, stale=True)
 
 
 @require_jwt(admin_mode=True)
@@ -76,7 +91,10 @@ def edit_question(req: ParsedRequest, event: str, number: int, creds=CredManager
 
 
 @require_jwt(admin_mode=True)
-@cache(lambda event, **_: f"{event}-questions-list")
+@cache(
+    lambda event, **_: f"{event}-questions-list",
+    tags=lambda event, **_: for_event(event, QUESTIONS),
+)
 def list_questions(event, creds=CredManager):
     return [x.as_json for x in get_question_list(event)]
 
@@ -111,9 +129,8 @@ def question_mutation(json: dict, event: str, question_number=None):
         question.answer = answer or question.answer
         js = question.as_json
     save_to_db()
-    return invalidate(
-        [f"question-{event}-{question_number}", f"{event}-questions-list"], js
-    )
+    # the questions list and every worker's question snapshot
+    return invalidate_tagged(of(event, QUESTIONS), js)
 
 
 @require_jwt(admin_mode=True)
@@ -129,7 +146,7 @@ def edit_event(req: ParsedRequest, event, creds=CredManager):
     ev.event_end_time = end_time
     ev.is_over = is_over
     save_to_db()
-    return invalidate(["events-list", f"{event}-event-details"], {"success": True})
+    return invalidate_tagged([EVENTS, of(event, DETAILS)], {"success": True})
 
 
 @require_jwt(admin_mode=True)
@@ -141,7 +158,9 @@ def add_notification(req: ParsedRequest, event_name: str, creds=CredManager):
     event.notifications = notifs
     flag_modified(event, "notifications")
     save_to_db()
-    return invalidate(f"{event_name}-notifications", {"success": True})
+    live.publish(event_name, live.NOTIFICATIONS, notifs)
+    tag = of(event_name, cache_tags.NOTIFICATIONS)
+    return invalidate_tagged(tag, {"success": True}, stale=True)
 
 
 @require_jwt(admin_mode=True)
@@ -152,11 +171,17 @@ def delete_notification(event_name: str, ts, creds=CredManager):
     n.sort(key=lambda x: x["ts"], reverse=True)
     event.notifications = n
     save_to_db()
-    return invalidate(f"{event_name}-notifications", {"success": True})
+    live.publish(event_name, live.NOTIFICATIONS, n)
+    tag = of(event_name, cache_tags.NOTIFICATIONS)
+    return invalidate_tagged(tag, {"success": True}, stale=True)
 
 
 @require_jwt(admin_mode=True)
-@cache(lambda event, **_: f"{event}-user-count", timeout=20)
+@cache(
+    lambda event, **_: f"{event}-user-count",
+    timeout=20,
+    tags=lambda event, **_: for_event(event, LEADERBOARD),
+)
 def user_count(event, creds=CredManager):
     return {"count": get_user_count(event)}
 
@@ -167,7 +192,37 @@ def logserver_key(creds=CredManager):
     return REMOTE_LOG_DB_KEY
 
 
+@require_jwt(admin_mode=True)
+def worker_metrics(creds=CredManager):
+    return metrics.collect()
+
+
 def invalidate_listener(req: ParsedRequest):
-    k = req.json["keys"]
-    invalidate_keys(k)
+    js = req.json
+    batch = js.get("batch")
+    if batch is None:
+        # from outside the cluster, applied here and passed on to the peers
+        invalidate_keys(js.get("keys", []))
+        invalidate_tags(js.get("tags", []))
+        return {"success": True}
+    # a batch from another node
+    signature = req.headers.get(invalidation_bus.SIGNATURE_HEADER)
+    if not invalidation_bus.verify(req.data, signature):
+        raise AppException("Invalid signature", HTTPStatus.FORBIDDEN)
+    try:
+        if not invalidation_bus.first_delivery(batch):
+            return {"success": True}
+    except ValueError as e:
+        raise AppException(str(e))
+    try:
+        invalidate_keys(js.get("keys", []), broadcast=False)
+        invalidate_keys(js.get("stale", []), stale=True, broadcast=False)
+        invalidate_tags(js.get("tags", []), broadcast=False)
+        invalidate_tags(js.get("stale_tags", []), stale=True, broadcast=False)
+        # leaderboards are kept per node, not in the response cache. question
+        # snapshots follow their tag by themselves ( see questions.py )
+        ranking.refresh_users(js.get("leaderboard", []))
+    except:
+        invalidation_bus.forget_delivery(batch)
+        raise
     return {"success": True}
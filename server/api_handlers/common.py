@@ -1,7 +1,9 @@
 from http import HTTPStatus
+from flask import g, has_request_context
+from server.cache_tags import DETAILS, for_event
 from server.response_caching import cache
 from typing import List
-from sqlalchemy import func as _func
+from sqlalchemy import func as _func, update as _update
 import requests
 
 from server.models import User as _U, Question as _Q, Event as _E
@@ -36,11 +38,61 @@ def delete_from_db(d, batch=False):
         not batch and save_to_db()
 
 
+def _request_users() -> dict:
+    # identity map for the current request, handlers ( and require_jwt )
+    # often look up the same user more than once
+    if not has_request_context():
+        return None
+    if "users" not in g:
+        g.users = {}
+    return g.users
+
+
 def get_user_by_id(idx: str) -> _U:
     idx = (idx or "").lower()
     if not idx or sanitize(idx) != idx:
         return _assert_exists(None)
-    return _assert_exists(_U.query.filter(lower(_U.user) == lower(idx)).first())
+    users = _request_users()
+    if users is not None and idx in users:
+        return users[idx]
+    user = _assert_exists(_U.query.filter(lower(_U.user) == lower(idx)).first())
+    if users is not None:
+        users[idx] = user
+    return user
+
+
+def advance_level(user: str, level: int, points: int, answered_at) -> dict:
+    # one conditional UPDATE .. RETURNING instead of a read-modify-write
+    # on the ORM object, it only matches if the user is still on `level`
+    # so two concurrent correct answers can never both be counted.
+    # returns the updated leaderboard row or None if nothing matched
+    stmt = (
+        _update(_U)
+        .where(
+            _U.user == user,
+            _U.level == level,
+            _U.is_disqualified.isnot(True),
+        )
+        .values(
+            level=_U.level + 1,
+            points=_U.points + points,
+            last_question_answered_at=answered_at,
+        )
+        .returning(
+            _U.user,
+            _U.name,
+            _U.points,
+            _U.level,
+            _U.is_admin,
+            _U.is_disqualified,
+            _U.last_question_answered_at,
+            _U.event,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    row = _db.session.execute(stmt).first()
+    save_to_db()
+    return dict(row._mapping) if row else None
 
 
 def get_question_by_id(event: str, number: int) -> _Q:
@@ -66,6 +118,29 @@ def get_user_list(event: str) -> List[_U]:
     return _U.query.order_by(_U.user.asc()).filter_by(event=event).all()
 
 
+def _leaderboard_query(event: str):
+    cols = (
+        _U.user,
+        _U.name,
+        _U.points,
+        _U.level,
+        _U.is_admin,
+        _U.is_disqualified,
+        _U.last_question_answered_at,
+    )
+    return _db.session.query(*cols).filter(_U.event == event)
+
+
+def get_leaderboard_rows(event: str) -> List[dict]:
+    return [dict(row._mapping) for row in _leaderboard_query(event).all()]
+
+
+def get_leaderboard_row(event: str, user: str) -> dict:
+    # None if there is no such user ( anymore ) in the event
+    row = _leaderboard_query(event).filter(_U.user == user).first()
+    return None if row is None else dict(row._mapping)
+
+
 def get_question_list(event: str) -> List[_Q]:
     return _Q.query.order_by(_Q.question_number.asc()).filter_by(event=event).all()
 
@@ -90,18 +165,16 @@ def _assert_exists(user: _U, name="User"):
     return user
 
 
-@cache(lambda event: f"{event}-event-details", json_cache=True)
+@cache(
+    lambda event: f"{event}-event-details",
+    json_cache=True,
+    tags=lambda event: for_event(event, DETAILS),
+)
 def get_event_details(event):
     ev = get_event_by_id(event)
     return ev.as_json
 
 
-@cache(lambda event, number: f"question-{event}-{number}", json_cache=True)
-def get_question(event, number):
-    q = get_question_by_id(event, number)
-    return q.as_json
-
-
 def send_webhook(url, json):
     return
     # return requests.post(url, json={**json, "allowed_mentions": {"parse": []}})
@@ -1,45 +1,96 @@
 from http import HTTPStatus
 from server.constants import (
+    EVENT_NAMES,
     IS_PROD,
     LOG_SERVER_ENDPOINT,
     MIN_QUESTION_TO_LOG,
     REMOTE_LOG_DB_KEY,
 )
-from server.response_caching import cache, invalidate
+from server.cache_tags import EVENTS, LEADERBOARD, NOTIFICATIONS, for_event, of
+from server.response_caching import cache, invalidate_tagged
 from time import time
 
 import requests
 
 from server.api_handlers.common import (
+    advance_level,
     get_event_by_id,
     get_event_details,
     get_events_list,
-    get_question,
     get_user_by_id,
     save_to_db,
     send_level_solved_webhook,
 )
 from server.api_handlers.cred_manager import CredManager
-from server.auth_token import require_jwt
-from server.util import js_time, only_keys, sanitize
+from server import leaderboard as ranking
+from server import questions
+from server.auth_token import issue_stream_token, require_jwt
+from server.danger import create_token
+from server.util import js_time, only_keys, sanitize, validate_num
 from server.models.user import User
 from server.util import AppException, ParsedRequest
 
 
-leaderboard_keys = ("user", "name", "points", "level", "is_admin", "is_disqualified")
+leaderboard_keys = ranking.LEADERBOARD_KEYS
+MAX_LEADERBOARD_PAGE = 200
+MAX_NEIGHBOURS = 25
 
 
-@cache(lambda x: f"{x}-leaderboard")
+@cache(
+    lambda x: f"{x}-leaderboard",
+    stale_ttl=5 * 60,
+    tags=lambda x: for_event(x, LEADERBOARD),
+)
 def leaderboard(x):
-    users = User.query.order_by(
-        User.is_disqualified.asc(),
-        User.is_admin.asc(),
-        User.points.desc(),
-        User.level.desc(),
-        User.last_question_answered_at.asc(),
-    ).filter_by(event=x)
+    if x not in EVENT_NAMES:
+        return []
+    return ranking.serialize(x)
+
+
+def leaderboard_page(req: ParsedRequest, event):
+    args = req.args
+    if "offset" not in args and "limit" not in args:
+        return leaderboard(event)
+    if event not in EVENT_NAMES:
+        raise AppException("Event does not exist", HTTPStatus.NOT_FOUND)
+    offset = validate_num(args.get("offset", 0))
+    limit = min(
+        validate_num(args.get("limit", MAX_LEADERBOARD_PAGE)), MAX_LEADERBOARD_PAGE
+    )
+
+    def run(board):
+        return {
+            "users": board.page(offset, limit),
+            "offset": offset,
+            "limit": limit,
+            "total": len(board),
+        }
 
-    return [only_keys(x.as_json, *leaderboard_keys) for x in users.all()]
+    return ranking.with_board(event, run)
+
+
+@require_jwt()
+def my_rank(req: ParsedRequest, event, creds: CredManager = CredManager):
+    if event not in EVENT_NAMES:
+        raise AppException("Event does not exist", HTTPStatus.NOT_FOUND)
+    around = min(validate_num(req.args.get("around", 2)), MAX_NEIGHBOURS)
+    user = creds.user
+
+    def run(board):
+        idx = board.index(user)
+        if idx is None:
+            raise AppException("You are not on this leaderboard", HTTPStatus.NOT_FOUND)
+        start = max(idx - around, 0)
+        return {
+            "rank": idx + 1,
+            "total": len(board),
+            "neighbours": {
+                "offset": start,
+                "users": board.page(start, idx - start + around + 1),
+            },
+        }
+
+    return ranking.with_board(event, run)
 
 
 @require_jwt()
@@ -50,15 +101,10 @@ def question(event, creds: CredManager = CredManager):
         raise AppException("Not your event..")
     if user.is_disqualified:
         return {"disqualified": True, "reason": user.disqualification_reason}
-    try:
-        try:
-            q = get_question(event, user.level)
-        except AppException:
-            return {"game_over": True}
-        q.pop("_secure_")
-        return q
-    except:
-        raise Exception("Unknown error occured")
+    q = questions.get(event, user.level)
+    if q is None:
+        return {"game_over": True}
+    return q
 
 
 @require_jwt()
@@ -75,18 +121,20 @@ def answer(req: ParsedRequest, event, creds: CredManager = CredManager):
     if user.is_disqualified:
         return {"disqualified": True, "reason": user.disqualification_reason}
     try:
-        try:
-            q = get_question(event, user.level)
-        except AppException:
+        q = questions.get(event, user.level)
+        if q is None:
             return {"game_over": True}
-        is_correct = sanitize(q["_secure_"]["answer"]) == answer
+        is_correct = questions.is_correct(event, user.level, answer)
         log_answer(user.user, q["question_number"], js["answer"], is_correct)
         if is_correct:
-            user.level += 1
-            user.points += q["question_points"]
-            user.last_question_answered_at = time()
-            save_to_db()
-            return invalidate(f"{event}-leaderboard", {"is_correct": is_correct})
+            row = advance_level(user.user, user.level, q["question_points"], time())
+            if row is None:
+                # a concurrent submission already moved this user past the level
+                return {"is_correct": False}
+            ranking.record(row)
+            return invalidate_tagged(
+                of(event, LEADERBOARD), {"is_correct": is_correct}, stale=True
+            )
         return {"is_correct": is_correct}
 
     except Exception as e:
@@ -118,11 +166,29 @@ def log_answer(user, question, answer, is_correct):
 
 
 @require_jwt()
-@cache(lambda x, **_: f"{x}-notifications", timeout=5 * 60 * 60)
 def get_notifications(x, creds=CredManager):
+    return notifications(x)
+
+
+@require_jwt()
+def stream_token(event, creds: CredManager = CredManager):
+    # for /play/<event>/stream/?token=.. ( see stream.py ), the notifications
+    # are only streamed to holders of a token, like the route above
+    if event not in EVENT_NAMES:
+        raise AppException("Event does not exist", HTTPStatus.NOT_FOUND)
+    return {"token": create_token(issue_stream_token(creds.access_token, event))}
+
+
+@cache(
+    lambda x: f"{x}-notifications",
+    timeout=5 * 60 * 60,
+    stale_ttl=5 * 60,
+    tags=lambda x: for_event(x, NOTIFICATIONS),
+)
+def notifications(x):
     return get_event_by_id(x).notifications
 
 
-@cache("events-list")
+@cache("events-list", stale_ttl=5 * 60, tags=[EVENTS])
 def list_events():
     return get_events_list()
@@ -1,7 +1,8 @@
 from http import HTTPStatus
 from re import IGNORECASE
 from re import compile as _compile
-from server.response_caching import invalidate
+from server.cache_tags import LEADERBOARD, of
+from server.response_caching import invalidate_tagged
 from urllib.parse import urlencode
 
 # pylint: disable=no-name-in-module
@@ -39,6 +40,7 @@ from .common import (
     send_admin_action_webhook,
 )
 from .cred_manager import CredManager
+from server import leaderboard as ranking
 
 # regex to find the offending column
 # there must be a better way - RH
@@ -83,8 +85,9 @@ def register(request: _Parsed):
         )
         js = user_data.as_json
         add_to_db(user_data)
+        ranking.record(js)
         send_acount_creation_webhook(user, name, event)
-        return invalidate(f"{event}-leaderboard", js)
+        return invalidate_tagged(of(event, LEADERBOARD), js, stale=True)
     except Exception as e:
         check_integrity_error(e)
 
@@ -268,6 +271,8 @@ def edit(request: _Parsed, user: str, creds: CredManager = CredManager):
         raise AppException("Requested field cannot be edited", HTTPStatus.BAD_REQUEST)
 
     user_data = get_user_by_id(user)
+    # an admin may move a user to another event or rename them
+    prev_event, prev_user = user_data.event, user_data.user
     text = []
     who = creds.user
     did_change = False
@@ -292,7 +297,11 @@ def edit(request: _Parsed, user: str, creds: CredManager = CredManager):
     if creds.is_admin and text:
         send_admin_action_webhook(text)
     if did_change:
-        return invalidate(f"{event}-leaderboard", js)
+        if (prev_event, prev_user) != (event, js["user"]):
+            ranking.record_removal(prev_event, prev_user)
+        ranking.record(js)
+        tags = {of(prev_event, LEADERBOARD), of(event, LEADERBOARD)}
+        return invalidate_tagged(list(tags), js, stale=True)
     return js
 
 
@@ -4,6 +4,7 @@ from bugsnag.flask import handle_exceptions
 from server.app_init import app
 from server.routes import user, admin, play
 from server.constants import BUGSNAG_API_KEY, IS_PROD
+from server import gc_policy, janitor
 
 
 #if IS_PROD:
@@ -27,5 +28,11 @@ def favicon():
     return serve_static_file("favicon.ico")
 
 
+janitor.install()
+
+# has to stay last, freezes everything allocated while importing the app
+gc_policy.install(app)
+
+
 if __name__ == "__main__":
     app.run(debug=True)
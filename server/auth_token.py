@@ -1,12 +1,17 @@
 """Decorators that ensure authentication is provided
 """
 
+from collections import OrderedDict
+from hashlib import blake2b, sha256
+from hmac import compare_digest, new as hmac
 from http import HTTPStatus
+from threading import Lock
 from time import time
 from flask import request
 from .danger import (
     EMAIL_CONF_TOKEN,
     RESET_PASSWORD_TOKEN,
+    STREAM_TOKEN,
     decode_token as decode,
     ACCESS_TOKEN,
     REFRESH_TOKEN,
@@ -16,9 +21,57 @@ from .danger import (
 from .api_handlers.common import get_user_by_id
 from .util import AppException, get_bearer_token
 from .api_handlers.cred_manager import CredManager
-from .constants import REFRESH_TOKEN_SALT
+from .constants import (
+    LEGACY_REFRESH_TOKENS_UNTIL,
+    REFRESH_TOKEN_SALT,
+    SIGNING_KEY,
+    STREAM_TOKEN_TTL,
+    VERIFIED_TOKEN_CACHE_SIZE,
+)
 
 THREE_HOURS = 3 * 60 * 60
+INTEGRITY_PREFIX = "hmac$"
+_INTEGRITY_KEY = f"{SIGNING_KEY}{REFRESH_TOKEN_SALT}".encode()
+
+
+class VerifiedTokenCache:
+    # claims of tokens whose signature we already checked, keyed by a digest
+    # of the token and kept until the token's own `exp`
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def digest(token: str) -> bytes:
+        return blake2b(token.encode(), digest_size=16).digest()
+
+    def get(self, digest: bytes) -> dict:
+        with self._lock:
+            claims = self._entries.get(digest)
+            if claims is None:
+                return None
+            if claims["exp"] <= time():
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return claims
+
+    def set(self, digest: bytes, claims: dict):
+        if self.max_entries <= 0 or not isinstance(claims.get("exp"), (int, float)):
+            return
+        with self._lock:
+            self._entries[digest] = claims
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+verified_tokens = VerifiedTokenCache(VERIFIED_TOKEN_CACHE_SIZE)
 
 
 def require_jwt(strict=True, admin_mode=False):
@@ -43,8 +96,7 @@ def regenerate_access_token(refresh: dict) -> dict:
     integrity = refresh.get("integrity")
     data = get_user_by_id(user)
     is_admin = data.is_admin
-    current = get_integrity(data.user, data.password_hash)
-    if check(integrity, current):
+    if verify_integrity(integrity, data.user, data.password_hash):
         return (
             issue_access_token(user, is_admin),
             issue_refresh_token(user, data.password_hash),
@@ -60,6 +112,19 @@ def issue_email_confirmation_token(user: str):
     return {"token_type": EMAIL_CONF_TOKEN, "user": user, "exp": time() + THREE_HOURS}
 
 
+def issue_stream_token(access: dict, event: str):
+    # EventSource can't send an Authorization header, this goes in the query
+    # string instead. it only has to be valid when the stream is opened,
+    # the stream itself ends when the access token it was issued for expires
+    return {
+        "token_type": STREAM_TOKEN,
+        "user": access["user"],
+        "event": event,
+        "until": access.get("exp"),
+        "exp": time() + STREAM_TOKEN_TTL,
+    }
+
+
 def issue_password_reset_token(user, phash):
     return {
         "token_type": RESET_PASSWORD_TOKEN,
@@ -73,7 +138,7 @@ def issue_refresh_token(username, password_hash):
     return {
         "token_type": REFRESH_TOKEN,
         "user": username,
-        "integrity": generate_password_hash(get_integrity(username, password_hash)),
+        "integrity": sign_integrity(username, password_hash),
     }
 
 
@@ -83,6 +148,24 @@ def get_integrity(username: str, password_hash: str):
     return f"{username}{REFRESH_TOKEN_SALT}{password_hash}"
 
 
+def sign_integrity(username: str, password_hash: str) -> str:
+    # keyed HMAC over the same material the argon2 hash used to cover,
+    # a new password ( hash ) or a new salt still revokes every issued token
+    msg = get_integrity(username, password_hash).encode()
+    return f"{INTEGRITY_PREFIX}{hmac(_INTEGRITY_KEY, msg, sha256).hexdigest()}"
+
+
+def verify_integrity(integrity: str, username: str, password_hash: str) -> bool:
+    if not isinstance(integrity, str):
+        return False
+    if integrity.startswith(INTEGRITY_PREFIX):
+        return compare_digest(integrity, sign_integrity(username, password_hash))
+    # argon2 based tokens issued before the switch
+    if time() > LEGACY_REFRESH_TOKENS_UNTIL:
+        return False
+    return check(integrity, get_integrity(username, password_hash))
+
+
 def get_token(strict=True):
     headers = request.headers
     received_access_token = get_bearer_token(headers)
@@ -94,7 +177,7 @@ def get_token(strict=True):
             )
         return None
     try:
-        access = decode(received_access_token)
+        access = decode_verified(received_access_token)
     except Exception:
         if strict:
             raise AppException("invalid token", HTTPStatus.BAD_REQUEST)
@@ -104,3 +187,16 @@ def get_token(strict=True):
         raise AppException("refresh", HTTPStatus.OK)
 
     return access
+
+
+def decode_verified(token: str) -> dict:
+    # repeat requests with the same access token skip the signature check,
+    # the returned claims are shared, don't mutate them
+    digest = verified_tokens.digest(token)
+    claims = verified_tokens.get(digest)
+    if claims is not None:
+        return claims
+    claims = decode(token)
+    if claims is not None:
+        verified_tokens.set(digest, claims)
+    return claims
@@ -0,0 +1,140 @@
+"""Single file cache entries
+"""
+# a cache entry is one file: a fixed size header, the content type and the tag
+# generations, then the body in every stored encoding back to back. a hit is a
+# single read of a single file and nothing in it is json-parsed
+#   magic, version                  b"FGCE", VERSION
+#   flags                           SIDECARS
+#   time_stamp, timeout, stale_ttl  when it was written and for how long it may
+#                                   be served ( fresh, then stale )
+#   generation                      of the key ( see generations.py )
+#   etag                            hex, empty for bodies without one
+#   lengths                         content type, tags, then one per encoding
+# tags are "<generation> <tag>\n" lines. files with another magic or version
+# ( and the json meta files older versions wrote ) are never read, they miss
+# and are replaced by the next write or removed by the janitor
+from struct import Struct, error as StructError
+
+MAGIC = b"FGCE"
+VERSION = 1
+# the bodies were also written as plain files for nginx ( X-Accel-Redirect )
+SIDECARS = 1
+# the body is always stored as is, the others only when they are smaller
+ENCODINGS = ("identity", "gzip", "br")
+_HEADER = Struct(f"=4sHHdddq32sHI{len(ENCODINGS)}Q")
+HEADER_SIZE = _HEADER.size
+
+
+class StoredEntry:
+    __slots__ = (
+        "flags",
+        "time_stamp",
+        "timeout",
+        "stale_ttl",
+        "generation",
+        "etag",
+        "content_type",
+        "tags",
+        "bodies",
+    )
+
+    def __init__(
+        self,
+        flags,
+        time_stamp,
+        timeout,
+        stale_ttl,
+        generation,
+        etag,
+        content_type,
+        tags,
+        bodies=None,
+    ):
+        self.flags = flags
+        self.time_stamp = time_stamp
+        self.timeout = timeout
+        self.stale_ttl = stale_ttl
+        self.generation = generation
+        self.etag = etag
+        self.content_type = content_type
+        # tag -> generation
+        self.tags = tags
+        # encoding -> bytes, None when only the header was read
+        self.bodies = bodies
+
+
+def pack(entry: StoredEntry) -> bytes:
+    content_type = entry.content_type.encode()
+    tags = "".join(f"{g} {t}\n" for t, g in entry.tags.items()).encode()
+    bodies = [entry.bodies.get(encoding, b"") for encoding in ENCODINGS]
+    header = _HEADER.pack(
+        MAGIC,
+        VERSION,
+        entry.flags,
+        entry.time_stamp,
+        entry.timeout,
+        entry.stale_ttl,
+        entry.generation,
+        (entry.etag or "").encode(),
+        len(content_type),
+        len(tags),
+        *(len(b) for b in bodies),
+    )
+    return b"".join((header, content_type, tags, *bodies))
+
+
+def _unpack_header(buf) -> tuple:
+    # (entry without bodies, body lengths, offset of the first body)
+    try:
+        magic, version, *fields = _HEADER.unpack_from(buf)
+    except StructError:
+        raise ValueError("truncated cache entry") from None
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a cache entry of this version")
+    flags, time_stamp, timeout, stale_ttl, generation, etag = fields[:6]
+    ct_len, tags_len = fields[6:8]
+    offset = HEADER_SIZE + ct_len + tags_len
+    if len(buf) < offset:
+        raise ValueError("truncated cache entry")
+    content_type = bytes(buf[HEADER_SIZE : HEADER_SIZE + ct_len]).decode()
+    tags = {}
+    for line in bytes(buf[HEADER_SIZE + ct_len : offset]).decode().splitlines():
+        generation_, tag = line.split(" ", 1)
+        tags[tag] = int(generation_)
+    entry = StoredEntry(
+        flags,
+        time_stamp,
+        timeout,
+        stale_ttl,
+        generation,
+        etag.rstrip(b"\0").decode() or None,
+        content_type,
+        tags,
+    )
+    return entry, fields[8:], offset
+
+
+def unpack(buf: bytes) -> StoredEntry:
+    # ValueError for anything that isn't a complete entry of this version
+    entry, lengths, offset = _unpack_header(buf)
+    if len(buf) != offset + sum(lengths):
+        raise ValueError("truncated cache entry")
+    entry.bodies = {}
+    for encoding, length in zip(ENCODINGS, lengths):
+        if length:
+            entry.bodies[encoding] = buf[offset : offset + length]
+        offset += length
+    return entry
+
+
+def read_header(path) -> StoredEntry:
+    # everything but the bodies, without reading them
+    with open(path, "rb", buffering=0) as f:
+        buf = f.read(HEADER_SIZE)
+        try:
+            # magic, version, flags, 3 times, generation, etag, then the lengths
+            ct_len, tags_len = _HEADER.unpack_from(buf)[8:10]
+        except StructError:
+            raise ValueError("truncated cache entry") from None
+        buf += f.read(ct_len + tags_len)
+    return _unpack_header(buf)[0]
@@ -0,0 +1,34 @@
+"""Tags for cached responses
+"""
+# cached entries are tagged with what they were built from, writes invalidate
+# the tags they touched instead of assembling cache keys by hand.
+# every entry that belongs to an event is tagged with `event(name)` as well,
+# invalidating that covers everything of the event in one operation
+EVENTS = "events"
+DETAILS = "details"
+NOTIFICATIONS = "notifications"
+QUESTIONS = "questions"
+# everything built from the event's users ( leaderboard, user count )
+LEADERBOARD = "leaderboard"
+
+
+def event(name: str) -> str:
+    return f"event:{name}"
+
+
+def of(name: str, kind: str) -> str:
+    return f"{kind}:{name}"
+
+
+def for_event(name: str, kind: str) -> list:
+    # the tags of an entry of `kind` that belongs to the event
+    return [event(name), of(name, kind)]
+
+
+def kind_of(tag: str) -> str:
+    return tag.split(":", 1)[0]
+
+
+def slot(tag: str) -> str:
+    # tags have generations like keys ( see generations.py ), in the same table
+    return f"#{tag}"
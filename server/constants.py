@@ -1,3 +1,4 @@
+from json import loads as _loads
 from os import environ as _environ, path
 from pathlib import Path
 
@@ -13,6 +14,8 @@ if not IS_PROD:
 SIGNING_KEY = _environ["JWT_SIGNING_KEY"]
 # How long an access_token will last
 TOKEN_EXPIRATION_TIME_IN_SECONDS = 60 * int(_environ.get("TOKEN_EXPIRATION_TIME", 10))
+# per worker cache of already verified access tokens ( 0 disables it )
+VERIFIED_TOKEN_CACHE_SIZE = int(_environ.get("VERIFIED_TOKEN_CACHE_SIZE", 4096))
 
 FLASK_SECRET = _environ["FLASK_SECRET"]
 DATABASE_URL = (_environ.get("DATABASE_URL") or _environ["DB_URL"]).replace(
@@ -20,6 +23,13 @@ DATABASE_URL = (_environ.get("DATABASE_URL") or _environ["DB_URL"]).replace(
 )
 
 REFRESH_TOKEN_SALT = _environ["REFRESH_TOKEN_SALT"]
+# refresh tokens used to carry an argon2 hash as their integrity value,
+# they are accepted ( and rotated to the HMAC format ) until this unix timestamp.
+# refresh tokens don't expire, so the default closes the window a month after
+# the switch ( 2026-11-18 UTC ), whoever still has an old one signs in again
+LEGACY_REFRESH_TOKENS_UNTIL = float(
+    _environ.get("LEGACY_REFRESH_TOKENS_UNTIL", 1794960000)
+)
 BACKEND_WEBHOOK_URL = _environ["BACKEND_WEBHOOK_URL"]
 
 MAIL_USER = _environ["MAIL_USER"]
@@ -36,8 +46,83 @@ DISABLE_CACHING = _environ.get(
 FG_REQUEST_COUNT = int(_environ.get("FG_REQUEST_COUNT", 6))
 FG_PER = int(_environ.get("FG_PER", 2))
 MIN_QUESTION_TO_LOG = int(_environ.get("MIN_QUESTION_TO_LOG", 5))
-CACHE_DIR = str(Path(path.dirname(path.realpath(__file__)), "@cache").resolve())
+# per-worker in-memory tier in front of the filesystem response cache
+MEMORY_CACHE_MAX_BYTES = int(_environ.get("MEMORY_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+MEMORY_CACHE_MAX_ENTRIES = int(_environ.get("MEMORY_CACHE_MAX_ENTRIES", 1024))
+MEMORY_CACHE_TTL = int(_environ.get("MEMORY_CACHE_TTL", 60))
+# how long ( in seconds ) requests wait for another thread/worker that is
+# already recomputing the same cache key before doing it themselves
+SINGLE_FLIGHT_WAIT = float(_environ.get("SINGLE_FLIGHT_WAIT", 3))
+# coalesce invalidations per key family ( matched against the end of the key ),
+# the first invalidation expires the entry `window` seconds later and every
+# invalidation until then is folded into it
+INVALIDATION_WINDOWS: dict = _loads(
+    _environ.get("INVALIDATION_WINDOWS", '{"leaderboard": 2}')
+)
+# a leaderboard journal ( see leaderboard.py ) larger than this is started over,
+# every worker then rebuilds its board from the database once
+LEADERBOARD_JOURNAL_MAX_BYTES = int(
+    _environ.get("LEADERBOARD_JOURNAL_MAX_BYTES", 4 * 1024 * 1024)
+)
+# cached bodies at least this large are also stored precompressed
+COMPRESS_MIN_SIZE = int(_environ.get("COMPRESS_MIN_SIZE", 1024))
+# internal nginx location mapped to CACHE_DIR ( e.g. "/-/cache/" ), when set
+# cache hits are handed to nginx with X-Accel-Redirect instead of being sent
+# by the worker. leave unset when not running behind config/nginx.conf.erb
+ACCEL_REDIRECT_LOCATION = _environ.get("ACCEL_REDIRECT_LOCATION")
+# the server-sent events process ( see stream.py ): where it accepts clients
+# ( "unix:/path" or "host:port" ), where the workers send it updates and how
+# often idle streams get a keep-alive comment
+STREAM_BIND = _environ.get("STREAM_BIND", "unix:/tmp/stream.socket")
+STREAM_EVENTS_SOCKET = _environ.get("STREAM_EVENTS_SOCKET", "/tmp/stream-events.socket")
+STREAM_HEARTBEAT = float(_environ.get("STREAM_HEARTBEAT", 15))
+# how long a stream token ( see auth_token.issue_stream_token ) can be used to
+# open a stream
+STREAM_TOKEN_TTL = int(_environ.get("STREAM_TOKEN_TTL", 60))
+# other nodes ( comma separated base urls ) that are sent every cache invalidation
+# made on this one, batched over INVALIDATION_BATCH_WINDOW seconds
+INVALIDATION_PEERS = tuple(
+    x.strip() for x in _environ.get("INVALIDATION_PEERS", "").split(",") if x.strip()
+)
+INVALIDATION_BATCH_WINDOW = float(_environ.get("INVALIDATION_BATCH_WINDOW", 0.25))
+# shared by all nodes, batches between them are signed with it. without it
+# nothing is sent to INVALIDATION_PEERS and batches from them are refused
+INVALIDATION_SECRET = _environ.get("INVALIDATION_SECRET")
+# the janitor ( see janitor.py ) sweeps CACHE_DIR every JANITOR_INTERVAL seconds,
+# removes temp files, leases and bodies without an entry once they are
+# JANITOR_ORPHAN_AGE seconds old and evicts the least recently used entries
+# while the cache takes more than CACHE_MAX_BYTES ( 0 for no limit )
+JANITOR_INTERVAL = float(_environ.get("JANITOR_INTERVAL", 60))
+JANITOR_ORPHAN_AGE = float(_environ.get("JANITOR_ORPHAN_AGE", 10 * 60))
+CACHE_MAX_BYTES = int(_environ.get("CACHE_MAX_BYTES", 512 * 1024 * 1024))
+METRICS_FLUSH_INTERVAL = int(_environ.get("METRICS_FLUSH_INTERVAL", 5))
+# request threads per gunicorn worker, gunicorn.conf.py reads the same variable
+WORKER_THREADS = int(_environ.get("WORKER_THREADS", 4))
+# password hashing processes per worker ( 0 hashes on the request thread ).
+# every pending hash ( running or waiting for a process ) holds a request
+# thread until it is done, so at most WORKER_THREADS - HASH_RESERVED_THREADS of
+# them may be pending, the reserved threads keep serving everything else while
+# further logins are rejected with a 503
+HASH_POOL_SIZE = int(_environ.get("HASH_POOL_SIZE", 2))
+HASH_RESERVED_THREADS = int(_environ.get("HASH_RESERVED_THREADS", 2))
+HASH_MAX_PENDING = max(WORKER_THREADS - HASH_RESERVED_THREADS, 1)
+# gc generation thresholds and when to collect: "auto" ( let the interpreter
+# decide ), "between-requests" or "idle", see gc_policy.py
+GC_THRESHOLDS = tuple(
+    int(x) for x in _environ.get("GC_THRESHOLDS", "10000,20,20").split(",")
+)
+GC_MODE = _environ.get("GC_MODE", "auto")
+GC_IDLE_INTERVAL = float(_environ.get("GC_IDLE_INTERVAL", 1))
+# seconds a starting worker ( or a preloading master ) may spend filling the
+# caches before it accepts traffic, whatever isn't warm by then is skipped
+WARM_UP_BUDGET = float(_environ.get("WARM_UP_BUDGET", 20))
+# overridable to run several instances on one machine. config/nginx.conf.erb
+# reads the same variable for the X-Accel-Redirect location
+CACHE_DIR = _environ.get("CACHE_DIR") or str(
+    Path(path.dirname(path.realpath(__file__)), "@cache").resolve()
+)
 EVENT_NAMES = ("intra", "main")
 del path
 del Path
 del _environ
+del _loads
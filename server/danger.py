@@ -6,17 +6,17 @@
 #   or requesting a new access_token to be done elsewhere )
 # ==============================================================
 
-from gc import collect
 from http import HTTPStatus
 from time import time as _time
 
 import jwt as _jwt
-import passlib.hash as _pwhash
 
 from .constants import SIGNING_KEY as _SIGNING_KEY
 from .constants import (
     TOKEN_EXPIRATION_TIME_IN_SECONDS as _TOKEN_EXPIRATION_TIME_IN_SECONDS,
 )
+from .hash_pool import hash_password as _hash_password
+from .hash_pool import verify_password as _verify_password
 from .util import AppException
 
 if _SIGNING_KEY is None:
@@ -26,23 +26,18 @@ if _SIGNING_KEY is None:
 if _TOKEN_EXPIRATION_TIME_IN_SECONDS is None:
     raise Exception("Specify token expiration time..")
 
-_hash_method = _pwhash.argon2.using(memory_cost=10 * 1024)
-
 _encode_token = _jwt.encode
 _decode_token = _jwt.decode
 
 # =======================================================================
 #                       Password Hashing
+#   ( argon2 runs in a bounded process pool, see hash_pool.py )
 def check_password_hash(_hash: str, pw: str) -> bool:
-    val = _hash_method.verify(pw, _hash)
-    collect()
-    return val
+    return _verify_password(pw, _hash)
 
 
 def generate_password_hash(pw):
-    val = _hash_method.hash(pw)
-    collect()
-    return val
+    return _hash_password(pw)
 
 
 # =======================================================================
@@ -51,11 +46,13 @@ ACCESS_TOKEN = "access"
 REFRESH_TOKEN = "refresh"
 EMAIL_CONF_TOKEN = "email_conf"
 RESET_PASSWORD_TOKEN = "reset_pass"
+STREAM_TOKEN = "stream"
 _ALLOWED_TOKEN_TYPES = (
     ACCESS_TOKEN,
     REFRESH_TOKEN,
     EMAIL_CONF_TOKEN,
     RESET_PASSWORD_TOKEN,
+    STREAM_TOKEN,
 )
 
 _EXPIRED = _jwt.exceptions.ExpiredSignatureError
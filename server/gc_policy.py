@@ -0,0 +1,136 @@
+"""Garbage collector tuning
+"""
+# the cyclic gc is a stop-the-world pass on whatever request thread happens
+# to allocate when a threshold is crossed. this module
+#   - raises the generation thresholds ( GC_THRESHOLDS )
+#   - freezes everything that exists after the app is imported, so those
+#     objects ( most of the heap, shared with the master when preloading )
+#     are never scanned again
+#   - optionally ( GC_MODE ) turns off automatic collection and runs the same
+#     schedule outside of requests instead:
+#       "between-requests": after a response has been sent
+#       "idle": from a timer thread while no request is in flight
+#   - records collection counts and pause times in the metrics module
+import gc
+from os import register_at_fork
+from threading import Lock, Thread
+from time import perf_counter, sleep
+
+from flask import g
+
+from server import metrics
+from server.constants import GC_IDLE_INTERVAL, GC_MODE, GC_THRESHOLDS
+
+AUTO = "auto"
+BETWEEN_REQUESTS = "between-requests"
+IDLE = "idle"
+
+# [collections, total pause, longest pause] per generation, only touched
+# from the gc callback which can't take locks ( it may run while one is held )
+_pauses = [[0, 0.0, 0.0] for _ in range(3)]
+_started = [0.0]
+_active = [0]
+_active_lock = Lock()
+
+
+def _on_gc(phase, info):
+    if phase == "start":
+        _started[0] = perf_counter()
+        return
+    elapsed = perf_counter() - _started[0]
+    stats = _pauses[info["generation"]]
+    stats[0] += 1
+    stats[1] += elapsed
+    stats[2] = max(stats[2], elapsed)
+
+
+def _report():
+    counters = {}
+    for gen, s in enumerate(gc.get_stats()):
+        counters[f"gc.gen{gen}.collections"] = s["collections"]
+        counters[f"gc.gen{gen}.collected"] = s["collected"]
+    return {
+        "counters": counters,
+        "gauges": {"gc.frozen": gc.get_freeze_count()},
+        "timings": {
+            f"gc.pause.gen{gen}": list(p) for gen, p in enumerate(_pauses) if p[0]
+        },
+    }
+
+
+def due_generation():
+    # the same decision CPython makes on allocation, None if nothing is due
+    t0, t1, t2 = gc.get_threshold()
+    c0, c1, c2 = gc.get_count()
+    if c2 > t2 and t2:
+        return 2
+    if c1 > t1 and t1:
+        return 1
+    if c0 > t0 and t0:
+        return 0
+    return None
+
+
+def collect_if_due():
+    gen = due_generation()
+    if gen is not None:
+        gc.collect(gen)
+
+
+def _idle_collector():
+    while True:
+        sleep(GC_IDLE_INTERVAL)
+        if not _active[0]:
+            collect_if_due()
+
+
+def _track(delta):
+    with _active_lock:
+        _active[0] += delta
+
+
+def _after_fork():
+    # pauses of the master aren't ours and threads don't survive a fork
+    for p in _pauses:
+        p[:] = [0, 0.0, 0.0]
+    if GC_MODE == IDLE:
+        Thread(target=_idle_collector, daemon=True).start()
+
+
+def install(app):
+    gc.set_threshold(*GC_THRESHOLDS)
+    gc.callbacks.append(_on_gc)
+    metrics.register(_report)
+
+    if GC_MODE == BETWEEN_REQUESTS:
+        gc.disable()
+
+        @app.after_request
+        def _collect_after_response(resp):
+            resp.call_on_close(collect_if_due)
+            return resp
+
+    elif GC_MODE == IDLE:
+        gc.disable()
+
+        @app.before_request
+        def _request_started():
+            g.gc_tracked = True
+            _track(1)
+
+        @app.teardown_request
+        def _request_finished(_):
+            if g.pop("gc_tracked", False):
+                _track(-1)
+
+        Thread(target=_idle_collector, daemon=True).start()
+
+    register_at_fork(after_in_child=_after_fork)
+    freeze()
+
+
+def freeze():
+    # everything allocated so far lives for the whole process. called again
+    # by a preloading master after warming up, right before it forks workers
+    gc.collect()
+    gc.freeze()
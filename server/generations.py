@@ -0,0 +1,126 @@
+"""Generation counters for cache keys
+"""
+# invalidating a key doesn't touch its files, it bumps the key's generation in a
+# small table shared by every process on this host ( an mmap'd file in CACHE_DIR ).
+# entries remember the generation they were computed for, an entry computed for
+# an older generation simply isn't fresh anymore. so a reader that finishes
+# computing after an invalidation can't bring stale data back, and old entries
+# are just overwritten by the next write ( or removed by a cleanup later on ).
+# keys are hashed into SLOTS slots, keys that share a slot are invalidated
+# together ( an extra miss, never a stale hit ). every slot holds
+#   generation      bumped by every invalidation
+#   hard            generation of the last hard invalidation, entries older
+#                   than that may not even be served stale
+#   invalidated_at  when `generation` took effect, in the future while a
+#                   deferred invalidation is pending
+#   previous_at     when the generation before it took effect
+import mmap
+from fcntl import LOCK_EX, LOCK_UN, lockf
+from os import O_CREAT, O_RDWR, fstat, ftruncate, open as os_open
+from pathlib import Path
+from struct import Struct
+from threading import Lock
+from time import time
+from zlib import crc32
+
+from server.constants import CACHE_DIR
+
+FILE_NAME = "~generations"
+SLOTS = 4096
+_GENERATION = Struct("=Q")
+_REST = Struct("=Qdd")
+SLOT_SIZE = _GENERATION.size + _REST.size
+
+_lock = Lock()
+_fd = None
+_table = None
+
+
+def _open():
+    global _fd, _table
+    with _lock:
+        if _table is None:
+            fd = os_open(Path(CACHE_DIR, FILE_NAME), O_RDWR | O_CREAT, 0o644)
+            size = SLOTS * SLOT_SIZE
+            if fstat(fd).st_size < size:
+                # zero filled, every process that gets here grows it to the same size
+                ftruncate(fd, size)
+            _table = mmap.mmap(fd, size)
+            _fd = fd
+    return _table
+
+
+def _offset(key: str) -> int:
+    return crc32(key.encode()) % SLOTS * SLOT_SIZE
+
+
+def state(key: str) -> tuple:
+    # (generation, hard, invalidated_at, previous_at)
+    table = _table or _open()
+    offset = _offset(key)
+    # the generation is written last and read first, a reader racing a bump
+    # sees either the old generation or the new one with its times
+    (generation,) = _GENERATION.unpack_from(table, offset)
+    return (generation, *_REST.unpack_from(table, offset + _GENERATION.size))
+
+
+def _bump(key: str, effective_at: float, hard: bool, only_if_settled: bool) -> bool:
+    table = _table or _open()
+    offset = _offset(key)
+    with _lock:
+        # the thread lock for this process, lockf for the others
+        lockf(_fd, LOCK_EX, SLOT_SIZE, offset)
+        try:
+            generation, prev_hard, invalidated_at, _ = state(key)
+            now = time()
+            if only_if_settled and invalidated_at > now:
+                return False
+            generation += 1
+            hard_generation = generation if hard else prev_hard
+            previous_at = min(invalidated_at, now)
+            _REST.pack_into(
+                table,
+                offset + _GENERATION.size,
+                hard_generation,
+                effective_at,
+                previous_at,
+            )
+            _GENERATION.pack_into(table, offset, generation)
+            return True
+        finally:
+            lockf(_fd, LOCK_UN, SLOT_SIZE, offset)
+
+
+def bump(key: str, hard: bool = False):
+    # hard: older entries can't be served at all, otherwise they still may be
+    # served stale ( see `cache(..., stale_ttl=...)` )
+    _bump(key, time(), hard, only_if_settled=False)
+
+
+def defer(key: str, window: float) -> bool:
+    # invalidates `key` `window` seconds from now, False if an invalidation
+    # is pending already ( this one is folded into it )
+    return _bump(key, time() + window, hard=False, only_if_settled=True)
+
+
+def for_write(key: str) -> int:
+    # the generation to stamp on an entry that is computed now, captured
+    # before computing. while a deferred invalidation is pending the entry
+    # belongs to the generation before it and expires with it as well
+    generation, _, invalidated_at, _ = state(key)
+    if invalidated_at > time():
+        return generation - 1
+    return generation
+
+
+def superseded_at(key: str, entry_generation: int) -> float:
+    # when an entry of `entry_generation` stopped ( or stops ) being current,
+    # inf if it still is and None if it can't be used at all
+    generation, hard, invalidated_at, previous_at = state(key)
+    if entry_generation == generation:
+        return float("inf")
+    if entry_generation < hard or entry_generation > generation:
+        return None
+    if entry_generation == generation - 1:
+        return invalidated_at
+    return previous_at
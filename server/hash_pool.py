@@ -0,0 +1,94 @@
+"""Bounded process pool for password hashing
+"""
+# argon2 with a 10 MiB memory cost is by far the most expensive thing a request
+# can do, running it inline lets a login/registration storm occupy every
+# request thread. hashes are handed to a small, per-worker process pool instead
+# and at most HASH_MAX_PENDING of them ( fewer than the worker has threads, see
+# constants.py ) may be pending at once, anything beyond that is rejected
+# immediately with a 503
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from multiprocessing import get_context
+from os import getpid
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+
+import passlib.hash as _pwhash
+
+from server import metrics
+from server.constants import HASH_MAX_PENDING, HASH_POOL_SIZE
+from server.util import AppException
+
+_hash_method = _pwhash.argon2.using(memory_cost=10 * 1024)
+
+_slots = BoundedSemaphore(HASH_MAX_PENDING)
+_lock = Lock()
+_pending = 0
+_executor = None
+_executor_pid = None
+
+
+# these two run inside the pool processes
+def _hash(pw: str) -> str:
+    return _hash_method.hash(pw)
+
+
+def _verify(pw: str, _hash_: str) -> bool:
+    return _hash_method.verify(pw, _hash_)
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    # created lazily so that a preloading gunicorn master never owns one,
+    # and re-created after a fork or if a pool process died
+    global _executor, _executor_pid
+    with _lock:
+        if _executor is None or _executor_pid != getpid():
+            _executor = ProcessPoolExecutor(
+                HASH_POOL_SIZE, mp_context=get_context("spawn")
+            )
+            _executor_pid = getpid()
+        return _executor
+
+
+def _reset_executor():
+    global _executor
+    with _lock:
+        _executor = None
+
+
+def _track(delta: int):
+    global _pending
+    with _lock:
+        _pending += delta
+        metrics.gauge("password_hash.queue_depth", _pending)
+
+
+def _run(fn, *args):
+    if not _slots.acquire(blocking=False):
+        metrics.incr("password_hash.rejected")
+        raise AppException(
+            "Server is busy, please try again", HTTPStatus.SERVICE_UNAVAILABLE
+        )
+    _track(1)
+    start = perf_counter()
+    try:
+        if HASH_POOL_SIZE <= 0:
+            return fn(*args)
+        try:
+            return _get_executor().submit(fn, *args).result()
+        except BrokenProcessPool:
+            _reset_executor()
+            return _get_executor().submit(fn, *args).result()
+    finally:
+        metrics.observe("password_hash.latency", perf_counter() - start)
+        _track(-1)
+        _slots.release()
+
+
+def hash_password(pw: str) -> str:
+    return _run(_hash, pw)
+
+
+def verify_password(pw: str, _hash_: str) -> bool:
+    return _run(_verify, pw, _hash_)
@@ -0,0 +1,188 @@
+"""Fan-out of cache invalidations to the other nodes
+"""
+# every node ( dyno ) has its own CACHE_DIR, leaderboard journals and question
+# snapshots, so keys invalidated here are also sent to every peer listed in
+# INVALIDATION_PEERS. keys are collected for INVALIDATION_BATCH_WINDOW seconds
+# and sent as one `POST /admin/-/invalidate/` per peer.
+# every peer has its own queue and sender thread: a batch that could not be
+# delivered is retried as is ( same id ) with a backoff, without holding up the
+# other peers, keys invalidated meanwhile wait for the next batch.
+# applying an invalidation twice is harmless, receivers additionally skip batch
+# ids any worker of their node has already applied: the first one to create
+# the batch's marker file in CACHE_DIR applies it, the janitor removes markers
+# after SEEN_BATCH_AGE seconds.
+# tags ( see cache_tags.py ) travel the same way as keys. leaderboard changes
+# travel as just (event, user), peers re-read that user's row from the shared
+# database ( see leaderboard.py ) so batches arriving out of order can't roll a
+# row back.
+# batches are signed with INVALIDATION_SECRET ( HMAC-SHA256 of the body ),
+# DEALER_KEY only gets them past the gate every public request passes through.
+# without a secret nothing is sent and batches from peers are refused
+import hmac
+import re
+from hashlib import sha256
+from json import dumps
+from os import O_CREAT, O_EXCL, O_WRONLY, close, getpid, open as os_open
+from pathlib import Path
+from threading import Condition, Lock, Thread
+from time import sleep
+from uuid import uuid4
+
+import requests
+
+from server import metrics
+from server.constants import (
+    CACHE_DIR,
+    DEALER_KEY,
+    INVALIDATION_BATCH_WINDOW,
+    INVALIDATION_PEERS,
+    INVALIDATION_SECRET,
+)
+from server.safe_io import safe_remove
+
+LISTENER_PATH = "/admin/-/invalidate/"
+PEER_TIMEOUT = 2
+MAX_BACKOFF = 30
+SIGNATURE_HEADER = "x-invalidation-signature"
+BATCH_MARKER_PREFIX = "~batch-"
+# how long a node remembers the batches it applied
+SEEN_BATCH_AGE = 60 * 60
+_BATCH_ID = re.compile("[0-9a-f]{32}")
+
+
+class Peer:
+    def __init__(self, base_url: str):
+        self.url = base_url.rstrip("/") + LISTENER_PATH
+        # (is_tag, key) -> stale
+        self.pending = {}
+        # (event, user) of changed leaderboard rows
+        self.pending_users = set()
+        self._cond = Condition()
+
+    def add(self, items):
+        with self._cond:
+            for key, stale in items:
+                # a hard invalidation wins over a stale one
+                self.pending[key] = self.pending.get(key, True) and stale
+            self._cond.notify()
+
+    def add_user(self, event: str, user: str):
+        with self._cond:
+            self.pending_users.add((event, user))
+            self._cond.notify()
+
+    def _take_batch(self) -> dict:
+        def select(is_tag, stale):
+            return [k for (t, k), s in pending.items() if t == is_tag and s == stale]
+
+        with self._cond:
+            pending, self.pending = self.pending, {}
+            users, self.pending_users = self.pending_users, set()
+        return {
+            "batch": uuid4().hex,
+            "keys": select(False, False),
+            "stale": select(False, True),
+            "tags": select(True, False),
+            "stale_tags": select(True, True),
+            "leaderboard": [list(x) for x in users],
+        }
+
+    def run(self):
+        backoff = 0
+        while True:
+            with self._cond:
+                while not self.pending and not self.pending_users:
+                    self._cond.wait()
+            # let the batch fill up
+            sleep(INVALIDATION_BATCH_WINDOW)
+            batch = self._take_batch()
+            while not self.send(batch):
+                backoff = min(max(backoff * 2, 0.5), MAX_BACKOFF)
+                sleep(backoff)
+            backoff = 0
+
+    def send(self, js: dict) -> bool:
+        body = dumps(js).encode()
+        headers = {
+            "x-access-key": DEALER_KEY,
+            "content-type": "application/json",
+            SIGNATURE_HEADER: sign(body),
+        }
+        try:
+            resp = requests.post(
+                self.url, data=body, headers=headers, timeout=PEER_TIMEOUT
+            )
+            resp.raise_for_status()
+        except requests.RequestException as e:
+            print("Could not send invalidations to", self.url, e)
+            metrics.incr("invalidation.peer_failures")
+            return False
+        metrics.incr("invalidation.batches_sent")
+        sent = sum(len(js[k]) for k in ("keys", "stale", "tags", "stale_tags"))
+        metrics.incr("invalidation.keys_sent", sent)
+        metrics.incr("invalidation.users_sent", len(js["leaderboard"]))
+        return True
+
+
+_lock = Lock()
+_peers = []
+_peers_pid = None
+
+
+def _get_peers() -> list:
+    # sender threads don't survive a fork, every worker starts its own
+    global _peers, _peers_pid
+    with _lock:
+        if _peers_pid != getpid():
+            _peers = [Peer(url) for url in INVALIDATION_PEERS]
+            for peer in _peers:
+                Thread(target=peer.run, daemon=True).start()
+            _peers_pid = getpid()
+        return _peers
+
+
+def broadcast(keys, stale=False, tags=False):
+    # tags: `keys` are cache tags
+    if not INVALIDATION_PEERS or not INVALIDATION_SECRET:
+        return
+    for peer in _get_peers():
+        peer.add(((tags, key), stale) for key in keys)
+
+
+def broadcast_user(event: str, user: str):
+    # the user's leaderboard row changed ( see leaderboard.py )
+    if not INVALIDATION_PEERS or not INVALIDATION_SECRET:
+        return
+    for peer in _get_peers():
+        peer.add_user(event, user)
+
+
+def sign(body: bytes) -> str:
+    return hmac.new(INVALIDATION_SECRET.encode(), body, sha256).hexdigest()
+
+
+def verify(body: bytes, signature: str) -> bool:
+    # True if the batch was signed by a node that has the same secret
+    if not INVALIDATION_SECRET or not signature:
+        return False
+    return hmac.compare_digest(sign(body), signature)
+
+
+def _marker_path(batch_id: str) -> Path:
+    if not _BATCH_ID.fullmatch(batch_id):
+        raise ValueError("invalid batch id")
+    return Path(CACHE_DIR, BATCH_MARKER_PREFIX + batch_id)
+
+
+def first_delivery(batch_id: str) -> bool:
+    # False if a worker of this node already applied the batch ( a retried send )
+    try:
+        close(os_open(_marker_path(batch_id), O_WRONLY | O_CREAT | O_EXCL, 0o644))
+    except FileExistsError:
+        return False
+    return True
+
+
+def forget_delivery(batch_id: str):
+    # the batch could not be applied, let the sender's retry through
+    safe_remove(_marker_path(batch_id))
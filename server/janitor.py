@@ -0,0 +1,230 @@
+"""Background cleanup of CACHE_DIR
+"""
+# nothing removes cache files on the request path: expired entries may still be
+# served stale, invalidations only bump a generation ( see generations.py ) and
+# a worker that dies mid-write leaves its temp file or lease behind.
+# one process per host ( whichever holds the lock on LOCK_NAME, the others
+# retry every interval ) sweeps CACHE_DIR every JANITOR_INTERVAL seconds and
+#   - removes entries that can't be served anymore, not even stale
+#   - removes temp files, leases, lockfiles of the old write protocol and body
+#     files without an entry once they are JANITOR_ORPHAN_AGE seconds old, and
+#     the meta files of the old json format
+#   - removes the markers of applied invalidation batches once they are
+#     SEEN_BATCH_AGE seconds old ( see invalidation_bus.py ) and the metrics
+#     dumps of workers that are gone ( see metrics.py )
+#   - evicts the least recently used entries while the cache is larger than
+#     CACHE_MAX_BYTES. "used" is the latest atime ( relatime still updates it
+#     on the first read after a write ) or mtime of the entry and its body
+#     files. hits from the memory tier don't touch them
+# files are only removed if they weren't rewritten since they were looked at,
+# racing a writer costs at most one extra miss.
+# everything else ( ~generations, ~tag-*, leaderboard journals ) is left alone
+from fcntl import LOCK_EX, LOCK_NB, lockf
+from os import O_CREAT, O_RDWR, close, open as os_open, register_at_fork, scandir
+from os import stat, unlink
+from pathlib import Path
+from threading import Lock, Thread
+from time import perf_counter, sleep, time
+
+from server import cache_entry, metrics
+from server.constants import (
+    CACHE_DIR,
+    CACHE_MAX_BYTES,
+    JANITOR_INTERVAL,
+    JANITOR_ORPHAN_AGE,
+)
+from server.invalidation_bus import BATCH_MARKER_PREFIX, SEEN_BATCH_AGE
+from server.metrics import MAX_DUMP_AGE, METRICS_PREFIX
+from server.response_caching import (
+    DATA_SUFFIX,
+    ENCODING_SUFFIXES,
+    ENTRY_SUFFIX,
+    LEASE_SUFFIX,
+    served_until,
+)
+from server.safe_io import TEMPFILE_SUFFIX
+
+LOCK_NAME = "~janitor.lock"
+# entries before the single file format ( see cache_entry.py )
+LEGACY_META_SUFFIX = ".meta.json"
+# lockfiles from before the atomic writes of safe_io.py
+LEGACY_LOCK_SUFFIX = "~#.lock"
+# evicting stops once the cache is down to this share of CACHE_MAX_BYTES
+LOW_WATER = 0.9
+
+_lock = Lock()
+_lock_fd = None
+
+
+class _Entry:
+    __slots__ = ("key", "path", "mtime", "files", "size", "used_at")
+
+    def __init__(self, key, path, st):
+        self.key = key
+        self.path = path
+        self.mtime = st.st_mtime_ns
+        # plain body files ( for nginx ) that belong to the entry
+        self.files = []
+        self.size = st.st_size
+        self.used_at = max(st.st_atime, st.st_mtime)
+
+
+def _body_key(name: str):
+    # the key a body file ( or one of its variants ) belongs to, None for others
+    for suffix in ("", *ENCODING_SUFFIXES.values()):
+        if name.endswith(DATA_SUFFIX + suffix):
+            return name[: -len(DATA_SUFFIX + suffix)]
+    return None
+
+
+def _remove(path, not_newer_than=None):
+    # the size of the removed file, None if it was gone or rewritten meanwhile
+    try:
+        st = stat(path)
+        if not_newer_than is not None and st.st_mtime_ns > not_newer_than:
+            return None
+        unlink(path)
+    except OSError:
+        return None
+    return st.st_size
+
+
+def _remove_entry(entry: _Entry):
+    # the entry first, from then on readers miss. body files are written before
+    # the entry that refers to them, newer ones belong to a newer entry
+    freed = _remove(entry.path, entry.mtime)
+    if freed is None:
+        return None
+    for path, _ in entry.files:
+        freed += _remove(path, entry.mtime) or 0
+    return freed
+
+
+def _scan(now: float):
+    entries, bodies, strays = {}, {}, []
+    with scandir(CACHE_DIR) as it:
+        for f in it:
+            try:
+                st = f.stat()
+            except FileNotFoundError:
+                continue
+            if f.name.endswith(ENTRY_SUFFIX):
+                key = f.name[: -len(ENTRY_SUFFIX)]
+                entries[key] = _Entry(key, f.path, st)
+            elif f.name.endswith(LEGACY_META_SUFFIX):
+                strays.append(f.path)
+            elif f.name.endswith((TEMPFILE_SUFFIX, LEASE_SUFFIX, LEGACY_LOCK_SUFFIX)):
+                if now - st.st_mtime > JANITOR_ORPHAN_AGE:
+                    strays.append(f.path)
+            elif f.name.startswith(BATCH_MARKER_PREFIX):
+                if now - st.st_mtime > SEEN_BATCH_AGE:
+                    strays.append(f.path)
+            elif f.name.startswith(METRICS_PREFIX):
+                # dumps are replaced as a whole, their mtime is their updated_at
+                if now - st.st_mtime > MAX_DUMP_AGE:
+                    strays.append(f.path)
+            else:
+                key = _body_key(f.name)
+                if key is not None:
+                    bodies.setdefault(key, []).append((f.path, st))
+    return entries, bodies, strays
+
+
+def sweep() -> dict:
+    now = time()
+    stats = {"expired": 0, "orphaned": 0, "evicted": 0, "reclaimed_bytes": 0}
+    entries, bodies, strays = _scan(now)
+
+    live = []
+    for key, entry in entries.items():
+        entry.files = bodies.pop(key, [])
+        for _, st in entry.files:
+            entry.size += st.st_size
+            entry.used_at = max(entry.used_at, st.st_atime)
+        try:
+            until = served_until(key, cache_entry.read_header(entry.path))
+        except (OSError, ValueError):
+            # gone already, or written by another version
+            until = None
+        if until is None or until < now:
+            freed = _remove_entry(entry)
+            if freed is not None:
+                stats["expired"] += 1
+                stats["reclaimed_bytes"] += freed
+        else:
+            live.append(entry)
+
+    # bodies without an entry, the entry may just be being written
+    for files in bodies.values():
+        for path, st in files:
+            if now - st.st_mtime > JANITOR_ORPHAN_AGE:
+                strays.append(path)
+    for path in strays:
+        freed = _remove(path)
+        if freed is not None:
+            stats["orphaned"] += 1
+            stats["reclaimed_bytes"] += freed
+
+    total = sum(e.size for e in live)
+    if CACHE_MAX_BYTES and total > CACHE_MAX_BYTES:
+        live.sort(key=lambda e: e.used_at)
+        for entry in live:
+            if total <= CACHE_MAX_BYTES * LOW_WATER:
+                break
+            freed = _remove_entry(entry)
+            if freed is not None:
+                stats["evicted"] += 1
+                stats["reclaimed_bytes"] += freed
+                total -= entry.size
+    stats["cache_bytes"] = total
+    return stats
+
+
+def _elect() -> bool:
+    # True while this process holds the host wide janitor lock, released by
+    # the kernel when the holder exits
+    global _lock_fd
+    with _lock:
+        if _lock_fd is not None:
+            return True
+        fd = os_open(Path(CACHE_DIR, LOCK_NAME), O_RDWR | O_CREAT, 0o644)
+        try:
+            lockf(fd, LOCK_EX | LOCK_NB)
+        except OSError:
+            close(fd)
+            return False
+        _lock_fd = fd
+        return True
+
+
+def _run():
+    while True:
+        sleep(JANITOR_INTERVAL)
+        if not _elect():
+            continue
+        try:
+            started = perf_counter()
+            stats = sweep()
+        except Exception as e:
+            print(e)
+            continue
+        metrics.observe("janitor.sweep", perf_counter() - started)
+        metrics.gauge("janitor.cache_bytes", stats.pop("cache_bytes"))
+        for name, value in stats.items():
+            if value:
+                metrics.incr(f"janitor.{name}", value)
+
+
+def _after_fork():
+    # threads don't survive a fork and lockf locks aren't inherited
+    global _lock, _lock_fd
+    _lock = Lock()
+    if _lock_fd is not None:
+        close(_lock_fd)
+        _lock_fd = None
+    Thread(target=_run, daemon=True).start()
+
+
+def install():
+    Thread(target=_run, daemon=True).start()
+    register_at_fork(after_in_child=_after_fork)
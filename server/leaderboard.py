@@ -0,0 +1,226 @@
+"""Incrementally maintained ranked leaderboards
+"""
+# every worker keeps one sorted structure per event, built once from the database
+# and then updated in O(log n) whenever a user changes.
+# writers append the changed row to a per-event journal in the cache directory
+# ( a single O_APPEND write ), every worker replays the journal lines it has not
+# seen yet before reading its board, so all workers converge on the same ranking
+# without going back to the database.
+# a journal that grew past LEADERBOARD_JOURNAL_MAX_BYTES is replaced by an empty
+# one ( a new inode ). workers notice the new inode ( or a journal shorter than
+# what they have read, or a missing one ) and rebuild their board from the
+# database, the lines they may have missed were committed to it already
+# every change is also published to the live stream ( see live.py ) as a delta
+# carrying the user's new rank. the other nodes are told which user changed
+# ( see invalidation_bus.py ) and apply the user's row as it is in the database
+from json import dumps, loads
+from os import fstat, stat
+from pathlib import Path
+from threading import Lock
+
+from sortedcontainers import SortedList
+
+from server import invalidation_bus, live
+from server.api_handlers.common import get_leaderboard_row, get_leaderboard_rows
+from server.constants import CACHE_DIR, EVENT_NAMES, LEADERBOARD_JOURNAL_MAX_BYTES
+from server.safe_io import open_and_append, open_and_write
+
+LEADERBOARD_KEYS = ("user", "name", "points", "level", "is_admin", "is_disqualified")
+# kept on the row for ordering but not sent to the client
+_ROW_KEYS = LEADERBOARD_KEYS + ("last_question_answered_at",)
+JOURNAL_SUFFIX = "-leaderboard.journal"
+_UPSERT = "u"
+_REMOVE = "r"
+# the same operations as sent to live stream subscribers
+_UPSERT_OP = "upsert"
+_REMOVE_OP = "remove"
+
+
+def sort_key(row: dict) -> tuple:
+    # same order as
+    #   is_disqualified asc, is_admin asc, points desc, level desc,
+    #   last_question_answered_at asc ( nulls last )
+    # with the username as a final tie breaker
+    ts = row["last_question_answered_at"]
+    return (
+        bool(row["is_disqualified"]),
+        bool(row["is_admin"]),
+        -(row["points"] or 0),
+        -(row["level"] or 0),
+        ts is None,
+        ts or 0,
+        row["user"],
+    )
+
+
+class Leaderboard:
+    def __init__(self, rows, offset: int, inode: int):
+        # how far into which journal file the board is
+        self.offset = offset
+        self.inode = inode
+        self._rows = {}
+        self._order = SortedList()
+        for row in rows:
+            self.upsert(row)
+
+    def upsert(self, row: dict):
+        self.remove(row["user"])
+        key = sort_key(row)
+        self._rows[row["user"]] = (key, {k: row.get(k) for k in _ROW_KEYS})
+        self._order.add(key)
+
+    def remove(self, user: str):
+        prev = self._rows.pop(user, None)
+        if prev is not None:
+            self._order.remove(prev[0])
+
+    def __len__(self):
+        return len(self._order)
+
+    def public_row(self, key: tuple) -> dict:
+        row = self._rows[key[-1]][1]
+        return {k: row[k] for k in LEADERBOARD_KEYS}
+
+    def as_list(self):
+        return [self.public_row(key) for key in self._order]
+
+    def page(self, offset: int, limit: int) -> list:
+        keys = self._order.islice(offset, offset + limit)
+        return [self.public_row(key) for key in keys]
+
+    def index(self, user: str) -> int:
+        # 0 based position of the user, None if they are not on this board
+        entry = self._rows.get(user)
+        if entry is None:
+            return None
+        return self._order.index(entry[0])
+
+
+_boards = {}
+_locks = {}
+_registry_lock = Lock()
+
+
+def journal_path(event: str) -> Path:
+    return Path(CACHE_DIR, f"{event}{JOURNAL_SUFFIX}")
+
+
+def _journal_stat(event: str) -> tuple:
+    # (inode, size) of the journal, created if there is none
+    try:
+        st = stat(journal_path(event))
+    except FileNotFoundError:
+        open_and_append(journal_path(event), b"")
+        st = stat(journal_path(event))
+    return st.st_ino, st.st_size
+
+
+def _lock_for(event: str) -> Lock:
+    with _registry_lock:
+        return _locks.setdefault(event, Lock())
+
+
+def _sync(event: str, board: Leaderboard) -> bool:
+    # replay whatever the other workers appended since we last looked,
+    # returns True if the board has to be reloaded from the database
+    inode, size = _journal_stat(event)
+    if inode != board.inode or size < board.offset:
+        # started over, or truncated by hand
+        return True
+    if size == board.offset:
+        return False
+    with open(journal_path(event), "rb") as f:
+        if fstat(f.fileno()).st_ino != board.inode:
+            return True
+        f.seek(board.offset)
+        chunk = f.read(size - board.offset)
+    # only consume complete lines, the rest is picked up on the next sync
+    end = chunk.rfind(b"\n") + 1
+    for line in chunk[:end].splitlines():
+        op, data = loads(line)
+        if op == _UPSERT:
+            board.upsert(data)
+        elif op == _REMOVE:
+            board.remove(data)
+    board.offset += end
+    return False
+
+
+def _load(event: str) -> Leaderboard:
+    # caller holds the event lock
+    board = _boards.get(event)
+    if board is None or _sync(event, board):
+        # remember where the journal was *before* reading the database,
+        # anything appended while we query is replayed on top
+        inode, offset = _journal_stat(event)
+        rows = get_leaderboard_rows(event)
+        board = _boards[event] = Leaderboard(rows, offset, inode)
+        _sync(event, board)
+    return board
+
+
+def with_board(event: str, fn):
+    with _lock_for(event):
+        return fn(_load(event))
+
+
+def serialize(event: str) -> list:
+    return with_board(event, Leaderboard.as_list)
+
+
+def _append(event: str, op: str, data):
+    path = journal_path(event)
+    open_and_append(path, (dumps([op, data]) + "\n").encode())
+    if _journal_stat(event)[1] > LEADERBOARD_JOURNAL_MAX_BYTES:
+        # replaced rather than truncated: a new inode that readers notice, and
+        # a writer that opened the old one can only append to that
+        open_and_write(path, b"", mode="wb")
+
+
+def _rank(board: Leaderboard, user: str) -> int:
+    idx = board.index(user)
+    return None if idx is None else idx + 1
+
+
+def record(user_json: dict, broadcast=True):
+    # call after the change was committed, takes `User.as_json`
+    # ( or any dict with the leaderboard keys and the event )
+    # broadcast: also send the change to the other nodes
+    event, user = user_json["event"], user_json["user"]
+    _append(event, _UPSERT, {k: user_json.get(k) for k in _ROW_KEYS})
+    if broadcast:
+        invalidation_bus.broadcast_user(event, user)
+    try:
+        rank = with_board(event, lambda board: _rank(board, user))
+    except Exception as e:
+        # the change is committed already, subscribers just miss the rank
+        print(e)
+        rank = None
+    row = {k: user_json.get(k) for k in LEADERBOARD_KEYS}
+    live.publish(event, live.LEADERBOARD, {"op": _UPSERT_OP, "row": row, "rank": rank})
+
+
+def record_removal(event: str, user: str, broadcast=True):
+    _append(event, _REMOVE, user)
+    if broadcast:
+        invalidation_bus.broadcast_user(event, user)
+    live.publish(event, live.LEADERBOARD, {"op": _REMOVE_OP, "user": user})
+
+
+def refresh_users(users: list):
+    # [event, user] pairs another node changed ( invalidation_bus.broadcast_user ),
+    # the database has their latest rows whatever order the batches arrive in
+    for event, user in users:
+        if event not in EVENT_NAMES:
+            continue
+        row = get_leaderboard_row(event, user)
+        if row is None:
+            record_removal(event, user, broadcast=False)
+        else:
+            record({**row, "event": event}, broadcast=False)
+
+
+def reset(event: str):
+    # drop the in-memory board, it is rebuilt from the database on next use
+    with _lock_for(event):
+        _boards.pop(event, None)
@@ -0,0 +1,41 @@
+"""Publishing live updates to the server-sent events process
+"""
+# write paths call `publish` once their change is committed, the update is sent
+# as a single datagram to stream.py which pushes it to every subscriber of the
+# event. fire and forget: if the stream process is down or can't keep up the
+# update is dropped, clients still get it with their next full fetch
+from json import dumps
+from os import getpid
+from socket import AF_UNIX, SOCK_DGRAM, socket
+from threading import Lock
+
+from server import metrics
+from server.constants import STREAM_EVENTS_SOCKET
+
+LEADERBOARD = "leaderboard"
+NOTIFICATIONS = "notifications"
+
+_lock = Lock()
+_sock = None
+_sock_pid = None
+
+
+def _socket() -> socket:
+    global _sock, _sock_pid
+    with _lock:
+        if _sock is None or _sock_pid != getpid():
+            _sock = socket(AF_UNIX, SOCK_DGRAM)
+            # never block a request on a full receive buffer
+            _sock.setblocking(False)
+            _sock_pid = getpid()
+        return _sock
+
+
+def publish(event: str, kind: str, data):
+    msg = dumps({"event": event, "kind": kind, "data": data}).encode()
+    try:
+        _socket().sendto(msg, STREAM_EVENTS_SOCKET)
+    except OSError:
+        metrics.incr("stream.publish.dropped")
+        return
+    metrics.incr("stream.publish.sent")
@@ -0,0 +1,57 @@
+"""In-process memory tier for the response cache
+"""
+# every gunicorn worker keeps its own small LRU of hot cache entries ( their
+# metadata and pre-serialized body ) so a hit never touches the filesystem tier.
+# entries are tagged with a `token` describing the on-disk version they were
+# read from, if the token changes (another worker rewrote or invalidated the
+# entry) the memory copy is dropped and the filesystem tier is consulted again
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class MemoryCache:
+    def __init__(self, max_bytes: int, max_entries: int, ttl: int):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: str, token):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry_token, loaded_at, value, _ = entry
+            if entry_token != token or time() - loaded_at > self.ttl:
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, token, value: tuple, size: int):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (token, time(), value, size)
+            self.size += size
+            while self.size > self.max_bytes or len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+
+    def evict(self, key: str):
+        with self._lock:
+            self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[3]
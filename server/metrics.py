@@ -0,0 +1,167 @@
+"""Tiny in-process metrics
+"""
+# counters, gauges and timings are kept per worker process and dumped to
+# `CACHE_DIR/~metrics-<pid>.json` every few seconds, `collect` merges the
+# dumps of every worker on this host so any worker can report the totals.
+# the dumps of workers that are gone are removed by `collect` and the janitor.
+# a preloading gunicorn master ( see gunicorn.conf.py ) records its warm-up and
+# whatever its background threads do like any worker and flushes a dump of its
+# own, listed with the workers. forked workers start from zero
+from glob import glob
+from json import dumps, loads
+from os import getpid, register_at_fork
+from pathlib import Path
+from threading import Lock, Thread
+from time import sleep, time
+
+from server.constants import CACHE_DIR, METRICS_FLUSH_INTERVAL
+from server.safe_io import open_and_read, open_and_write, safe_remove
+
+METRICS_PREFIX = "~metrics-"
+# dumps older than this belong to workers that are gone
+MAX_DUMP_AGE = 10 * METRICS_FLUSH_INTERVAL
+
+_lock = Lock()
+_counters = {}
+_gauges = {}
+_timings = {}
+_sources = []
+_flusher_pid = None
+
+
+def incr(name: str, by: int = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + by
+    _ensure_flusher()
+
+
+def gauge(name: str, value):
+    with _lock:
+        _gauges[name] = value
+    _ensure_flusher()
+
+
+def observe(name: str, seconds: float):
+    with _lock:
+        count, total, peak = _timings.get(name, (0, 0.0, 0.0))
+        _timings[name] = (count + 1, total + seconds, max(peak, seconds))
+    _ensure_flusher()
+
+
+def register(source):
+    # `source()` returns extra {"counters": .., "gauges": .., "timings": ..}
+    # to merge into every snapshot, for stats that can't be recorded through
+    # incr/gauge/observe as they happen ( like the gc callbacks ).
+    # doesn't start the flusher by itself, that's up to the first metric
+    _sources.append(source)
+
+
+def process_memory(pid="self") -> dict:
+    # resident and proportional set size in bytes, pss splits the pages shared
+    # with the master and the other workers between them so summing it over
+    # all workers gives the real total. empty where /proc isn't available
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return {}
+    ret = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        if name in ("Rss", "Pss"):
+            ret[name.lower()] = int(value.split()[0]) * 1024
+    return ret
+
+
+def _report_memory():
+    mem = process_memory()
+    return {"gauges": {f"process.{k}_bytes": v for k, v in mem.items()}}
+
+
+def snapshot() -> dict:
+    with _lock:
+        snap = {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "timings": {k: list(v) for k, v in _timings.items()},
+        }
+    for source in _sources:
+        for kind, values in source().items():
+            snap[kind].update(values)
+    return snap
+
+
+def dump_path(pid: int) -> Path:
+    return Path(CACHE_DIR, f"{METRICS_PREFIX}{pid}.json")
+
+
+def flush():
+    js = {"pid": getpid(), "updated_at": time(), **snapshot()}
+    open_and_write(dump_path(getpid()), dumps(js).encode(), mode="wb")
+
+
+def collect() -> dict:
+    flush()
+    now = time()
+    total = {"counters": {}, "gauges": {}, "timings": {}, "workers": []}
+    for fn in glob(str(Path(CACHE_DIR, f"{METRICS_PREFIX}*.json"))):
+        data = open_and_read(Path(fn))
+        try:
+            js = loads(data)
+        except Exception:
+            continue
+        if now - js["updated_at"] > MAX_DUMP_AGE:
+            safe_remove(fn)
+            continue
+        total["workers"].append(js["pid"])
+        for k, v in js["counters"].items():
+            total["counters"][k] = total["counters"].get(k, 0) + v
+        for k, v in js["gauges"].items():
+            total["gauges"][k] = total["gauges"].get(k, 0) + v
+        for k, (count, seconds, peak) in js["timings"].items():
+            c, s, p = total["timings"].get(k, (0, 0.0, 0.0))
+            total["timings"][k] = (c + count, s + seconds, max(p, peak))
+    total["timings"] = {
+        k: {"count": c, "total": s, "avg": s / c if c else 0, "max": p}
+        for k, (c, s, p) in total["timings"].items()
+    }
+    return total
+
+
+def _flush_forever():
+    while True:
+        sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            print(e)
+
+
+def _after_fork():
+    # a forked worker starts with fresh numbers ( and a lock nobody holds ),
+    # otherwise whatever the master recorded would be counted once per worker.
+    # the master's flusher thread isn't forked along, the worker's first metric
+    # starts one that writes the worker's own dump
+    global _lock, _flusher_pid
+    _lock = Lock()
+    _flusher_pid = None
+    _counters.clear()
+    _gauges.clear()
+    _timings.clear()
+
+
+def _ensure_flusher():
+    # started lazily ( and again after a fork ) by the first recorded metric
+    global _flusher_pid
+    pid = getpid()
+    if _flusher_pid == pid:
+        return
+    with _lock:
+        if _flusher_pid == pid:
+            return
+        _flusher_pid = pid
+    Thread(target=_flush_forever, daemon=True).start()
+
+
+register(_report_memory)
+register_at_fork(after_in_child=_after_fork)
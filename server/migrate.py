@@ -0,0 +1,17 @@
+"""Database changes to apply before a release starts serving
+"""
+# run once per deploy ( the release phase in Procfile, or by hand with
+# `python -m server.migrate` ), never from the workers' boot: building an index
+# on a large table takes a while and nothing bounds it there. fails loudly, a
+# release whose migration failed doesn't go out
+from server.app_init import app
+from server.models import ensure_indexes
+
+
+def main():
+    with app.app_context():
+        ensure_indexes()
+
+
+if __name__ == "__main__":
+    main()
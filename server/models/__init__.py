@@ -1,5 +1,35 @@
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex, DropIndex
+
 from .shared import db
 
 from .user import User
 from .question import Question
 from .event import Event
+
+
+_INDEX_IS_INVALID = text(
+    "SELECT NOT i.indisvalid FROM pg_index i "
+    "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+)
+
+
+def ensure_indexes():
+    # db.create_all only creates indexes together with new tables,
+    # this adds the ones that were introduced later to existing databases.
+    # run by server/migrate.py on every release: IF NOT EXISTS makes that a
+    # catalog lookup once the index is there, and building it CONCURRENTLY
+    # ( which postgres only does outside of a transaction ) doesn't block writes
+    # to the table meanwhile
+    # pylint: disable=E1101
+    engine = db.engine.execution_options(isolation_level="AUTOCOMMIT")
+    with engine.connect() as conn:
+        for index in User.__table__.indexes:
+            if conn.dialect.name == "postgresql" and conn.execute(
+                _INDEX_IS_INVALID, {"name": index.name}
+            ).scalar():
+                # left behind by a concurrent build that failed or was
+                # interrupted, IF NOT EXISTS would skip it for good
+                print("Rebuilding invalid index", index.name)
+                conn.execute(DropIndex(index, if_exists=True))
+            conn.execute(CreateIndex(index, if_not_exists=True))
@@ -6,6 +6,7 @@ from time import time
 
 from server.danger import generate_password_hash
 from server.util import AppException, sanitize, validate_email_address
+from sqlalchemy import func
 from sqlalchemy.orm import validates
 
 from .shared import db, raise_if_invalid_data
@@ -29,6 +30,12 @@ class User(db.Model):
     has_verified_email: bool = db.Column(db.Boolean)
     certificate_key: str = db.Column(db.String, unique=True)
     event: str = db.Column(db.String(10), nullable=False)
+    # every lookup is `lower(user) = lower(:user)`, without an expression index
+    # that is a sequential scan over the whole table. built concurrently by
+    # ensure_indexes ( see server/migrate.py ), outside of a transaction
+    __table_args__ = (
+        db.Index("ix_user_lower_user", func.lower(user), postgresql_concurrently=True),
+    )
     # pylint: enable=E1101
 
     @property
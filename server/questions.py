@@ -0,0 +1,64 @@
+"""Per-worker snapshots of every question of an event
+"""
+# questions only change through the admin panel, so every worker keeps an
+# immutable {number: question} map per event with the answers already sanitized.
+# serving a question or checking an answer is a dict lookup and a string compare.
+# an edit invalidates the event's questions tag ( see cache_tags.py ), workers
+# notice the tag's new generation on their next lookup and atomically swap in
+# a freshly loaded snapshot
+from threading import Lock
+
+from server import cache_tags, generations
+from server.api_handlers.common import get_question_list
+from server.constants import EVENT_NAMES
+from server.util import sanitize
+
+
+class Snapshot:
+    __slots__ = ("token", "questions", "answers")
+
+    def __init__(self, token, questions):
+        self.token = token
+        # public json ( without `_secure_` ), don't mutate these
+        self.questions = {}
+        self.answers = {}
+        for q in questions:
+            js = q.as_json
+            answer = js.pop("_secure_")["answer"]
+            self.questions[js["question_number"]] = js
+            self.answers[js["question_number"]] = sanitize(answer)
+
+
+_snapshots = {}
+_lock = Lock()
+
+
+def _version_token(event: str):
+    tag = cache_tags.of(event, cache_tags.QUESTIONS)
+    return generations.state(cache_tags.slot(tag))[0]
+
+
+def snapshot(event: str) -> Snapshot:
+    token = _version_token(event)
+    snap = _snapshots.get(event)
+    if snap is not None and snap.token == token:
+        return snap
+    with _lock:
+        snap = _snapshots.get(event)
+        if snap is None or snap.token != token:
+            snap = _snapshots[event] = Snapshot(token, get_question_list(event))
+        return snap
+
+
+def get(event: str, number: int) -> dict:
+    return snapshot(event).questions.get(number)
+
+
+def is_correct(event: str, number: int, answer: str) -> bool:
+    # `answer` has to be sanitized already
+    return snapshot(event).answers.get(number) == answer
+
+
+def load_all():
+    for event in EVENT_NAMES:
+        snapshot(event)
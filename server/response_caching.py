@@ -7,30 +7,134 @@
 # this makes response extremely fast as you skip a database hit as well as the json parsing and
 # serialising overhead
 # and sending binary using a wsgi server is pretty performant
+# hot keys are additionally kept in a per-worker memory tier ( see memory_cache.py )
+# so repeated hits are served straight from RAM
+# bodies are compressed once when they are written ( gzip, and brotli if it is
+# installed ) and hits are served in whatever encoding the client accepts,
+# nginx passes responses that already have a Content-Encoding through as they are
+# with ACCEL_REDIRECT_LOCATION set a hit only returns headers and an X-Accel-Redirect
+# to that internal nginx location, nginx then sends the file itself ( sendfile )
+# and the worker thread is free again right away. the encoding is picked here
+# and the redirect points at that exact variant, so it always matches the etag
+# entries can be tagged with what they were built from ( see cache_tags.py ),
+# `invalidate_tagged` then invalidates every entry carrying a tag at once.
+# which keys carry a tag is recorded in `~tag-<tag>` files, only to tell clients
+# the invalidated keys ( `x-invalidate` ), the generations decide what is fresh
+# an entry is a single file ( see cache_entry.py ), a hit from disk is one read.
+# with X-Accel-Redirect the bodies are written as plain files next to it as well
+# every entry carries an etag, hits are sent with `Cache-Control: no-cache` and
+# requests with a matching If-None-Match get a 304 without a body
 
 from functools import wraps
+from gzip import compress as gzip_compress
+from hashlib import blake2b
+from http import HTTPStatus
+from threading import Event, Lock, Thread
 from json import dumps, loads
 import json
 from os import stat
 from pathlib import Path
+from urllib.parse import quote
 from server.util import json_response
-from time import time
+from time import sleep, time
 
-from flask import make_response, Response
-from flask.helpers import send_file
+from flask import current_app, has_request_context, make_response, request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 from server.safe_io import (
+    acquire_lease,
+    open_and_append,
     open_and_read,
     open_and_write,
-    close_lockfile,
-    safe_mkdir,
+    release_lease,
     safe_remove,
 )
-from server.constants import CACHE_DIR, DISABLE_CACHING
-from gc import collect
+from server.constants import (
+    ACCEL_REDIRECT_LOCATION,
+    CACHE_DIR,
+    COMPRESS_MIN_SIZE,
+    DISABLE_CACHING,
+    INVALIDATION_WINDOWS,
+    MEMORY_CACHE_MAX_BYTES,
+    MEMORY_CACHE_MAX_ENTRIES,
+    MEMORY_CACHE_TTL,
+    SINGLE_FLIGHT_WAIT,
+)
+from server.memory_cache import MemoryCache
+from server import cache_entry, generations, invalidation_bus, metrics
+from server.cache_tags import kind_of, slot as tag_slot
 
 DEFAULT_CACHE_TIMEOUT = 60 * 60
+DEFAULT_CONTENT_TYPE = "application/json"
+ENTRY_SUFFIX = ".entry"
+# the plain body files nginx serves
 DATA_SUFFIX = ".cache.json"
+LEASE_SUFFIX = ".lease"
+TAG_INDEX_PREFIX = "~tag-"
+# how often a waiting worker checks whether the lease holder is done
+LEASE_POLL_INTERVAL = 0.025
+# content-coding -> suffix of the precompressed variant, in order of preference
+ENCODING_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+memory_tier = MemoryCache(
+    MEMORY_CACHE_MAX_BYTES, MEMORY_CACHE_MAX_ENTRIES, MEMORY_CACHE_TTL
+)
+
+
+class Body:
+    # a cached response body, `data` is the identity encoding and `encoded`
+    # maps content-codings to the same body compressed.
+    # `file_name` is the plain body file inside CACHE_DIR ( if there is one )
+    # and `etag` a hash of `data`, computed once when the entry is written.
+    # `value` is the parsed body for json_cache routes, shared by every hit
+    # on the same ( memory tier ) entry so don't mutate it
+    __slots__ = ("data", "encoded", "file_name", "etag", "content_type", "value")
+
+    def __init__(
+        self,
+        data,
+        encoded=None,
+        file_name=None,
+        etag=None,
+        content_type=DEFAULT_CONTENT_TYPE,
+    ):
+        self.data = data
+        self.encoded = encoded or {}
+        self.file_name = file_name
+        self.etag = etag
+        self.content_type = content_type
+        self.value = None
+
+    def __bool__(self):
+        return bool(self.data)
+
+    @property
+    def size(self):
+        return len(self.data) + sum(len(x) for x in self.encoded.values())
+
+
+def compress(data) -> dict:
+    # small bodies aren't worth it, and only keep variants that are smaller
+    if not isinstance(data, bytes) or len(data) < COMPRESS_MIN_SIZE:
+        return {}
+    encoded = {"gzip": gzip_compress(data, 9, mtime=0)}
+    if brotli is not None:
+        encoded["br"] = brotli.compress(data)
+    return {k: v for k, v in encoded.items() if len(v) < len(data)}
+
+
+def content_etag(data) -> str:
+    if not isinstance(data, bytes):
+        return None
+    return blake2b(data, digest_size=16).hexdigest()
+
+
+def variant_path(file_path, encoding):
+    return f"{file_path}{ENCODING_SUFFIXES[encoding]}"
 
 
 def file_size(fname):
@@ -42,72 +146,358 @@ def file_size(fname):
 
 
 def get_file_name(key):
-    return f"{key}.meta.json"
+    return f"{key}{ENTRY_SUFFIX}"
 
 
-def get_cache(key, timeout):
+def file_token(path):
+    # identifies the on-disk version of an entry, changes whenever
+    # any worker rewrites or removes the entry file
+    try:
+        st = stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def lookup(key):
+    # returns (time_stamp, generation, body, tag_generations) for the stored
+    # entry, fresh or not
     fn = get_file_name(key)
     path = Path(CACHE_DIR, fn)
-    data = open_and_read(path)
+    token = file_token(path)
+    if token is None:
+        memory_tier.evict(key)
+        return None
+    entry = memory_tier.get(key, token)
+    if entry is not None:
+        return entry
+    data = open_and_read(path, mode="rb")
     if data is None:
         return None
     try:
-        data = loads(data)
-    except Exception as e:
+        stored = cache_entry.unpack(data)
+    except ValueError as e:
+        # written by another version, the next write replaces it
         print(e)
-        safe_mkdir(path)
         return None
 
-    ret = data["data"]
-    ts = data["time_stamp"]
-    if time() - ts > timeout:
-        safe_remove(Path(CACHE_DIR, ret))
+    bodies = stored.bodies
+    body = Body(
+        bodies.pop("identity", b""),
+        bodies,
+        f"{key}{DATA_SUFFIX}" if stored.flags & cache_entry.SIDECARS else None,
+        stored.etag,
+        stored.content_type,
+    )
+    if not body:
         return None
-    if file_size(Path(CACHE_DIR, ret)):
-        return ret
-    return None
+    entry = (stored.time_stamp, stored.generation, body, stored.tags)
+    memory_tier.set(key, token, entry, body.size)
+    return entry
 
 
-def get_paths(key):
-    fn = get_file_name(key)
-    safe_mkdir(CACHE_DIR)
-    path = Path(CACHE_DIR, fn)
+def take_stamp(key, tags):
+    # the generations of the key and its tags, taken before computing a value
+    # so that an invalidation while computing makes the new entry stale
+    tag_generations = {tag: generations.for_write(tag_slot(tag)) for tag in tags}
+    return generations.for_write(key), tag_generations
+
+
+def superseded_at(key, entry):
+    # when the entry stopped being current ( inf if it still is ),
+    # None if it was invalidated for good
+    _, generation, _, tags = entry
+    times = [generations.superseded_at(key, generation)]
+    for tag, tag_generation in tags.items():
+        times.append(generations.superseded_at(tag_slot(tag), tag_generation))
+    if None in times:
+        return None
+    return min(times)
+
+
+def expiry(key, entry, timeout):
+    # when the entry expires(d), None if it was invalidated for good
+    superseded = superseded_at(key, entry)
+    if superseded is None:
+        return None
+    return min(entry[0] + timeout, superseded)
+
+
+def served_until(key, stored):
+    # the last moment a stored entry ( cache_entry.StoredEntry ) may be served,
+    # stale or not. None if it can't be served at all anymore
+    entry = (stored.time_stamp, stored.generation, None, stored.tags)
+    expires = expiry(key, entry, stored.timeout)
+    if expires is None:
+        return None
+    return expires + stored.stale_ttl
+
+
+def get_cache(key, timeout):
+    # expired entries are left on disk, they can still be served as a
+    # stale copy while someone else recomputes them
+    entry = lookup(key)
+    if entry is None:
+        return None
+    expires = expiry(key, entry, timeout)
+    if expires is None or time() > expires:
+        return None
+    return entry[2]
+
+
+def get_stale(key, timeout, stale_ttl):
+    # the expired copy while it is at most `stale_ttl` seconds past expiring,
+    # like the decorator itself would serve it
+    entry = lookup(key)
+    if entry is None or not stale_ttl:
+        return None
+    expires = expiry(key, entry, timeout)
+    if expires is None or time() - expires > stale_ttl:
+        return None
+    return entry[2]
+
+
+def write_sidecars(key, body, encoded):
+    # plain files for nginx, written before the entry that refers to them
     file_path = Path(CACHE_DIR, f"{key}{DATA_SUFFIX}")
-    return path, file_path
+    open_and_write(file_path, body, mode="wb")
+    for encoding in ENCODING_SUFFIXES:
+        variant = variant_path(file_path, encoding)
+        if encoding in encoded:
+            open_and_write(variant, encoded[encoding], mode="wb")
+        else:
+            # left over from an earlier, larger body ( nginx would serve it )
+            safe_remove(variant)
 
 
-def cache_data(key, data):
+def cache_data(key, data, stamp, timeout=DEFAULT_CACHE_TIMEOUT, stale_ttl=None):
+    # `stamp` has to be taken ( take_stamp ) before computing `data`.
+    # timeout and stale_ttl are only recorded for the janitor ( see janitor.py )
     try:
-        path, file_path = get_paths(key)
-        js = {"time_stamp": time(), "data": str(file_path.resolve())}
-        open_and_write(path, dumps(js).encode(), mode="wb")
-        open_and_write(
-            file_path,
-            dumps({"data": data}).encode() if isinstance(data, (dict, list)) else data,
-            mode="wb",
+        body = (
+            dumps({"data": data}).encode() if isinstance(data, (dict, list)) else data
         )
+        encoded = compress(body)
+        etag = content_etag(body)
+        file_name, flags = None, 0
+        if ACCEL_REDIRECT_LOCATION:
+            write_sidecars(key, body, encoded)
+            file_name, flags = f"{key}{DATA_SUFFIX}", cache_entry.SIDECARS
+        stored = cache_entry.StoredEntry(
+            flags,
+            time(),
+            timeout,
+            stale_ttl or 0,
+            stamp[0],
+            etag,
+            DEFAULT_CONTENT_TYPE,
+            stamp[1],
+            {"identity": body, **encoded},
+        )
+        path = Path(CACHE_DIR, get_file_name(key))
+        open_and_write(path, cache_entry.pack(stored), mode="wb")
+        index_tags(key, stamp[1])
+        return Body(body, encoded, file_name, etag)
     except Exception as e:
         print(e)
-        close_lockfile(path)
-        close_lockfile(file_path)
+        return None
+
 
+def _tag_index_path(tag):
+    return Path(CACHE_DIR, f"{TAG_INDEX_PREFIX}{tag}")
 
-def invalidate_keys(keys):
+
+def index_tags(key, tags):
+    # only misses write entries, reading the index on every write is cheap
+    for tag in tags:
+        path = _tag_index_path(tag)
+        if key not in (open_and_read(path) or "").splitlines():
+            open_and_append(path, f"{key}\n".encode())
+
+
+def keys_of(tags) -> list:
+    # every key that was written on this host with any of `tags`
+    keys = []
+    for tag in tags:
+        for key in (open_and_read(_tag_index_path(tag)) or "").splitlines():
+            if key not in keys:
+                keys.append(key)
+    return keys
+
+
+def invalidation_family(key):
+    for family in INVALIDATION_WINDOWS:
+        if key == family or key.endswith(f"-{family}"):
+            return family
+    return None
+
+
+def tag_family(tag):
+    kind = kind_of(tag)
+    return kind if kind in INVALIDATION_WINDOWS else None
+
+
+def defer_invalidation(key, family):
+    # debounced invalidation, the first dirtying write starts the window
+    # and later ones within it are coalesced
+    if generations.defer(key, INVALIDATION_WINDOWS[family]):
+        metrics.incr(f"cache.invalidations.deferred.{family}")
+    else:
+        metrics.incr(f"cache.invalidations.coalesced.{family}")
+
+
+def invalidate_keys(keys, stale=False, broadcast=True):
+    # only bumps the generation of every key ( see generations.py ), the files
+    # stay where they are until the key is written again.
+    # broadcast: also send the keys to the other nodes ( see invalidation_bus.py )
+    if broadcast:
+        invalidation_bus.broadcast(keys, stale)
     for key in keys:
-        info, binary = get_paths(key)
-        safe_remove(info)
-        safe_remove(binary)
-        close_lockfile(info)
-        close_lockfile(binary)
+        _invalidate_slot(key, invalidation_family(key), stale)
+
 
+def invalidate_tags(tags, stale=False, broadcast=True):
+    # invalidates every entry carrying any of `tags`, same as invalidate_keys
+    if broadcast:
+        invalidation_bus.broadcast(tags, stale, tags=True)
+    for tag in tags:
+        _invalidate_slot(tag_slot(tag), tag_family(tag), stale)
 
-def invalidate(keys, obj):
+
+def _invalidate_slot(slot, family, stale):
+    if family is not None:
+        defer_invalidation(slot, family)
+    else:
+        generations.bump(slot, hard=not stale)
+
+
+def invalidate(keys, obj, stale=False):
+    # pass stale=True to let `cache(..., stale_ttl=...)` routes keep serving
+    # the old response while it is rebuilt, routes without a stale_ttl
+    # treat a stale entry as a plain miss.
+    # keys that belong to a family in INVALIDATION_WINDOWS are expired lazily
     k = keys if isinstance(keys, (tuple, list)) else [keys]
-    invalidate_keys(k)
+    invalidate_keys(k, stale=stale)
     return get_invalidate_response(obj, k)
 
 
-def cache(key_method, timeout=DEFAULT_CACHE_TIMEOUT, json_cache: bool = False):
+def invalidate_tagged(tags, obj, stale=False):
+    # `invalidate` for tags ( see cache_tags.py ), `x-invalidate` still lists
+    # the affected keys and `x-invalidate-tags` the tags themselves
+    t = tags if isinstance(tags, (tuple, list)) else [tags]
+    invalidate_tags(t, stale=stale)
+    resp = get_invalidate_response(obj, keys_of(t))
+    resp.headers.set("x-invalidate-tags", json.dumps(list(t)))
+    return resp
+
+
+class _Flight:
+    # a recomputation in progress inside this worker
+    def __init__(self):
+        self.done = Event()
+        self.body = None
+
+
+_flights = {}
+_flights_lock = Lock()
+
+
+def _from_cache(body, json_cache):
+    if json_cache:
+        if body.value is None:
+            body.value = loads(body.data)["data"]
+        return body.value
+    return get_cache_response(body)
+
+
+def _wait_for_lease_holder(key, timeout, lease):
+    deadline = time() + SINGLE_FLIGHT_WAIT
+    while time() < deadline:
+        sleep(LEASE_POLL_INTERVAL)
+        body = get_cache(key, timeout)
+        if body:
+            return body
+        if not lease.exists():
+            return get_cache(key, timeout)
+    return None
+
+
+def _recompute(key, tags, timeout, stale_ttl, flight, func, args, kwargs):
+    # only one worker process recomputes a key at a time, the others serve
+    # the stale copy if it is still within stale_ttl or wait for the result
+    lease = Path(CACHE_DIR, f"{key}{LEASE_SUFFIX}")
+    if not acquire_lease(lease, SINGLE_FLIGHT_WAIT):
+        body = get_stale(key, timeout, stale_ttl) or _wait_for_lease_holder(
+            key, timeout, lease
+        )
+        if body:
+            flight.body = body
+            return body, None
+        # the holder is taking too long, don't keep the user waiting forever
+        stamp = take_stamp(key, tags)
+        result = func(*args, **kwargs)
+        flight.body = cache_data(key, result, stamp, timeout, stale_ttl)
+        return None, result
+    try:
+        # someone may have finished between our miss and taking the lease
+        body = get_cache(key, timeout)
+        if body:
+            flight.body = body
+            return body, None
+        print("Cache miss:", key)
+        # taken first, so an invalidation while computing makes this entry stale
+        stamp = take_stamp(key, tags)
+        result = func(*args, **kwargs)
+        flight.body = cache_data(key, result, stamp, timeout, stale_ttl)
+        return None, result
+    finally:
+        release_lease(lease)
+
+
+def wait_for_refreshes(timeout):
+    # blocks until the recomputations running right now have finished,
+    # returns False if some were still running after `timeout` seconds
+    deadline = time() + timeout
+    with _flights_lock:
+        flights = list(_flights.values())
+    for flight in flights:
+        if not flight.done.wait(max(deadline - time(), 0)):
+            return False
+    return True
+
+
+def _refresh_in_background(key, tags, timeout, stale_ttl, func, args, kwargs):
+    with _flights_lock:
+        if key in _flights:
+            return
+        flight = _flights[key] = _Flight()
+    app = current_app._get_current_object()
+
+    def run():
+        try:
+            with app.app_context():
+                _recompute(key, tags, timeout, stale_ttl, flight, func, args, kwargs)
+        except Exception as e:
+            print(e)
+        finally:
+            with _flights_lock:
+                _flights.pop(key, None)
+            flight.done.set()
+
+    Thread(target=run, daemon=True).start()
+
+
+def cache(
+    key_method,
+    timeout=DEFAULT_CACHE_TIMEOUT,
+    json_cache: bool = False,
+    stale_ttl: int = None,
+    tags=(),
+):
+    # stale_ttl: for how many seconds after expiring ( or a stale=True invalidation )
+    # an entry may still be served while a background thread rebuilds it
+    # tags: the entry's tags ( cache_tags.py ), or a function of the arguments
+    # like key_method
     def decorator(func):
         @wraps(func)
         def flask_cache(*args, **kwargs):
@@ -118,21 +508,48 @@ def cache(key_method, timeout=DEFAULT_CACHE_TIMEOUT, json_cache: bool = False):
                 if isinstance(key_method, str)
                 else key_method(*args, **kwargs)
             )
-            has_cache = get_cache(key, timeout)
-            if has_cache:
-                print("Cache hit:", key)
-                if json_cache:
+            entry_tags = tags(*args, **kwargs) if callable(tags) else tags
+            entry = lookup(key)
+            expires = expiry(key, entry, timeout) if entry else None
+            if expires is not None:
+                now = time()
+                has_cache = None
+                if now <= expires:
+                    print("Cache hit:", key)
+                    has_cache = entry[2]
+                elif stale_ttl and now - expires <= stale_ttl:
+                    print("Cache hit (stale):", key)
+                    _refresh_in_background(
+                        key, entry_tags, timeout, stale_ttl, func, args, kwargs
+                    )
+                    has_cache = entry[2]
+                if has_cache:
                     try:
-                        return loads(Path(has_cache).read_text())["data"]
+                        return _from_cache(has_cache, json_cache)
                     except:
                         pass
-                else:
-                    resp = get_cache_response(has_cache)
-                    return resp
-            print("Cache miss:", key)
-            result = func(*args, **kwargs)
-            cache_data(key, result)
-            print("gc:", collect())
+            # single flight: the first thread to miss recomputes the key,
+            # every other thread of this worker waits for its result
+            with _flights_lock:
+                flight = _flights.get(key)
+                is_leader = flight is None
+                if is_leader:
+                    flight = _flights[key] = _Flight()
+            if not is_leader:
+                flight.done.wait(SINGLE_FLIGHT_WAIT)
+                if flight.body:
+                    return _from_cache(flight.body, json_cache)
+                return func(*args, **kwargs)
+            try:
+                body, result = _recompute(
+                    key, entry_tags, timeout, stale_ttl, flight, func, args, kwargs
+                )
+            finally:
+                with _flights_lock:
+                    _flights.pop(key, None)
+                flight.done.set()
+            if body:
+                return _from_cache(body, json_cache)
             return result
 
         return flask_cache
@@ -152,12 +569,60 @@ def get_invalidate_response(ret, key):
     return json_response({"data": ret}, headers={"x-invalidate": key})
 
 
-def get_cache_response(has_cache, content_type="application/json"):
-    resp = make_response(send_file(has_cache))
+def negotiate_encoding(body):
+    # the preferred precompressed variant the client accepts, None for identity
+    if not body.encoded or not has_request_context():
+        return None
+    accepted = request.accept_encodings
+    for encoding in ENCODING_SUFFIXES:
+        if encoding in body.encoded and accepted.quality(encoding) > 0:
+            return encoding
+    return None
+
+
+def get_accel_response(body, content_type, encoding):
+    # nginx sends the variant file, with the headers set here
+    file_name = variant_path(body.file_name, encoding) if encoding else body.file_name
+    resp = make_response(b"")
+    resp.headers["X-Accel-Redirect"] = ACCEL_REDIRECT_LOCATION + quote(file_name)
     add_no_cache_headers(resp.headers, content_type)
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
     return resp
 
 
+def get_cache_response(body, content_type=None):
+    content_type = content_type or body.content_type
+    encoding = negotiate_encoding(body)
+    if ACCEL_REDIRECT_LOCATION and body.file_name and has_request_context():
+        resp = get_accel_response(body, content_type, encoding)
+    else:
+        resp = make_response(body.encoded[encoding] if encoding else body.data)
+        add_no_cache_headers(resp.headers, content_type)
+        if encoding:
+            resp.headers["Content-Encoding"] = encoding
+    if body.encoded:
+        resp.vary.add("Accept-Encoding")
+    if body.etag:
+        # every encoding is a different representation with its own etag
+        add_revalidate_headers(
+            resp, body.etag if encoding is None else f"{body.etag}-{encoding}"
+        )
+        if has_request_context():
+            # turns into a bodyless 304 if the client's copy is current
+            resp.make_conditional(request)
+            if resp.status_code == HTTPStatus.NOT_MODIFIED:
+                resp.headers.remove("X-Accel-Redirect")
+    return resp
+
+
+def add_revalidate_headers(resp, etag):
+    # clients may keep the response but have to revalidate it ( If-None-Match )
+    # before every use, unchanged entries then cost a 304 without a body
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+
+
 def add_no_cache_headers(headers, ct):
     # make sure that the browser does not think
     # that this is a static file sent
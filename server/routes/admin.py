@@ -73,3 +73,9 @@ def user_count(event):
 @api_response
 def invalidate_keys():
     return admin.invalidate_listener(ParsedRequest())
+
+
+@app.get("/admin/-/metrics/", strict_slashes=False)
+@api_response
+def worker_metrics():
+    return admin.worker_metrics()
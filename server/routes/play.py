@@ -8,7 +8,13 @@ from server.util import ParsedRequest, api_response
 @app.get("/play/<event>/leaderboard/", strict_slashes=False)
 @api_response
 def leaderboard(event):
-    return play.leaderboard(event)
+    return play.leaderboard_page(ParsedRequest(), event)
+
+
+@app.get("/play/<event>/leaderboard/me/", strict_slashes=False)
+@api_response
+def my_rank(event):
+    return play.my_rank(ParsedRequest(), event)
 
 
 # @app.get("/play/main/leaderboard/", strict_slashes=False)
@@ -34,6 +40,12 @@ def get_notifications(event):
     return play.get_notifications(event)
 
 
+@app.get("/play/<event>/stream-token/", strict_slashes=False)
+@api_response
+def stream_token(event):
+    return play.stream_token(event)
+
+
 @app.get("/play/events/", strict_slashes=False)
 @api_response
 def list_events():
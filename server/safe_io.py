@@ -1,51 +1,86 @@
-from os.path import basename
+from os import O_APPEND, O_CREAT, O_EXCL, O_WRONLY, close, getpid, replace, stat, write
+from os import open as _open
 from pathlib import Path
-from time import sleep
+from threading import get_ident
+from time import time
 
 from .constants import CACHE_DIR
 
-_LOCKFILE_SUFFIX = "~#.lock"
+# writers never touch the destination file directly, they write a private
+# temp file and atomically swap it in with `os.replace`.
+# readers therefore always see either the old or the new contents
+# and never have to wait for (or miss because of) a writer
+TEMPFILE_SUFFIX = "~#.tmp"
 
 
-def lockfile_path(original_file_name: str) -> str:
-    return Path(CACHE_DIR, f"{basename(original_file_name)}{_LOCKFILE_SUFFIX}")
+def temp_path(filename: Path) -> str:
+    return f"{filename}.{getpid()}.{get_ident()}{TEMPFILE_SUFFIX}"
 
 
-def create_lockfile(filename: str) -> str:
-    safe_mkdir(CACHE_DIR)
-    open(lockfile_path(filename), "w").close()
+def open_and_read(filename: Path, mode="r"):
+    try:
+        with open(filename, "rb", buffering=0) as f:
+            dx = f.read()
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+    if mode == "r":
+        dx = dx.decode().strip()
+    return dx or None
+
 
+def open_and_write(filename: Path, data, mode="w"):
+    tmp = temp_path(filename)
+    data = data.encode() if mode == "w" else data
+    try:
+        _write(tmp, data)
+    except FileNotFoundError:
+        # someone removed the cache directory under us
+        safe_mkdir(CACHE_DIR)
+        _write(tmp, data)
+    try:
+        replace(tmp, filename)
+    except:
+        safe_remove(tmp)
+        raise
 
-def close_lockfile(filename: str) -> str:
-    safe_mkdir(CACHE_DIR)
-    rm_path = lockfile_path(filename)
-    safe_remove(rm_path)
 
+def open_and_append(filename: Path, data: bytes):
+    # a single O_APPEND write, concurrent appends from other workers
+    # never interleave with it
+    fd = _open(filename, O_APPEND | O_CREAT | O_WRONLY)
+    try:
+        write(fd, data)
+    finally:
+        close(fd)
 
-def _lockfile_exists(filename: str) -> bool:
-    return Path(lockfile_path(filename)).exists()
 
+def _write(tmp: str, data: bytes):
+    with open(tmp, "wb") as f:
+        f.write(data)
 
-def open_and_read(filename: Path, mode="r"):
-    safe_mkdir(CACHE_DIR)
-    if not filename.exists():
-        return None
-    elif _lockfile_exists(filename):
-        return None
-    create_lockfile(filename)
-    dx = filename.read_text().strip() if mode == "r" else filename.read_bytes()
-    close_lockfile(filename)
-    return dx or None
 
+def acquire_lease(filename: Path, ttl: float) -> bool:
+    # cross process mutex for rare events ( cache recomputation )
+    # O_EXCL guarantees that exactly one process creates the file,
+    # a lease older than `ttl` belonged to a crashed holder and is taken over
+    for _ in range(2):
+        try:
+            close(_open(filename, O_CREAT | O_EXCL | O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time() - stat(filename).st_mtime < ttl:
+                    return False
+            except FileNotFoundError:
+                continue
+            safe_remove(filename)
+        except FileNotFoundError:
+            safe_mkdir(CACHE_DIR)
+    return False
 
-def open_and_write(filename: Path, data, mode="w"):
-    safe_mkdir(CACHE_DIR)
 
-    if _lockfile_exists(filename):
-        return None
-    create_lockfile(filename)
-    filename.write_text(data) if mode == "w" else filename.write_bytes(data)
-    close_lockfile(filename)
+def release_lease(filename: Path):
+    safe_remove(filename)
 
 
 def safe_mkdir(dir_name: str):
@@ -57,3 +92,6 @@ def safe_remove(filename: str):
         Path(filename).unlink()
     except:
         pass
+
+
+safe_mkdir(CACHE_DIR)
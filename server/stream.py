@@ -0,0 +1,231 @@
+"""Server-sent events for leaderboard and notification updates
+"""
+# runs as its own asyncio process ( started by gunicorn.conf.py, or with
+# `python -m server.stream` ) so an open stream costs a socket and a few hundred
+# bytes here instead of a gunicorn thread. nginx routes /play/<event>/stream/ to it.
+# updates arrive as datagrams from the workers ( see live.py ) and are written to
+# every subscriber of their event, subscribers that stop reading are dropped.
+# clients fetch the full leaderboard / notifications once and then apply:
+#   event: leaderboard     data: {"op": "upsert", "row": {..}, "rank": 3}
+#                                {"op": "remove", "user": "..."}
+#   event: notifications   data: [ the full list of notifications ]
+# the leaderboard is public like its polling route. notifications need a login
+# like theirs: browsers ( EventSource ) can't send headers, so the client gets a
+# short lived token from /play/<event>/stream-token/ and opens
+# /play/<event>/stream/?token=... the stream is closed once the access token
+# the stream token was issued for expires, the client then gets a new one
+import asyncio
+import resource
+import re
+from json import dumps, loads
+from socket import AF_UNIX, SOCK_DGRAM, SOL_SOCKET, SO_RCVBUF, socket
+from time import time
+from urllib.parse import parse_qs
+
+from server import metrics
+from server.constants import (
+    EVENT_NAMES,
+    STREAM_BIND,
+    STREAM_EVENTS_SOCKET,
+    STREAM_HEARTBEAT,
+)
+from server.danger import STREAM_TOKEN, decode_token
+from server.live import NOTIFICATIONS
+from server.safe_io import safe_remove
+
+_PATH = re.compile(r"^/play/([^/]+)/stream/?$")
+MAX_HEADER_SIZE = 8 * 1024
+HEADER_TIMEOUT = 5
+# how many bytes a subscriber may fall behind before it is dropped
+MAX_BACKLOG = 256 * 1024
+RETRY_MS = 3000
+HEARTBEAT = b": ping\n\n"
+
+
+class Hub:
+    def __init__(self):
+        # writer -> until when it may receive notifications, None if it can't
+        self.subscribers = {event: {} for event in EVENT_NAMES}
+        self.seq = 0
+
+    def add(self, event: str, writer: asyncio.StreamWriter, until=None):
+        self.subscribers[event][writer] = until
+        metrics.gauge(f"stream.subscribers.{event}", len(self.subscribers[event]))
+
+    def drop(self, event: str, writer: asyncio.StreamWriter):
+        self.subscribers[event].pop(writer, None)
+        metrics.gauge(f"stream.subscribers.{event}", len(self.subscribers[event]))
+        writer.close()
+
+    def send(self, event: str, chunk: bytes, private=False):
+        # private: only to subscribers that logged in
+        for writer, until in list(self.subscribers.get(event, {}).items()):
+            if private and until is None:
+                continue
+            transport = writer.transport
+            if transport.is_closing() or (
+                transport.get_write_buffer_size() > MAX_BACKLOG
+            ):
+                self.drop(event, writer)
+                continue
+            writer.write(chunk)
+
+    def publish(self, event: str, kind: str, data):
+        # formatted once, written to every subscriber as is
+        self.seq += 1
+        chunk = f"id: {self.seq}\nevent: {kind}\ndata: {dumps(data)}\n\n".encode()
+        self.send(event, chunk, private=kind == NOTIFICATIONS)
+        metrics.incr(f"stream.messages.{kind}")
+
+    async def heartbeat(self):
+        # keeps proxies from timing out idle streams and finds dead clients
+        while True:
+            await asyncio.sleep(STREAM_HEARTBEAT)
+            now = time()
+            for event, subscribers in self.subscribers.items():
+                for writer, until in list(subscribers.items()):
+                    if until is not None and until < now:
+                        self.drop(event, writer)
+                self.send(event, HEARTBEAT)
+
+
+class _Updates(asyncio.DatagramProtocol):
+    def __init__(self, hub: Hub):
+        self.hub = hub
+
+    def datagram_received(self, data, addr):
+        try:
+            msg = loads(data)
+            event, kind, payload = msg["event"], msg["kind"], msg["data"]
+        except (ValueError, KeyError, TypeError):
+            return
+        if event in self.hub.subscribers:
+            self.hub.publish(event, kind, payload)
+
+
+def _response(status: str, body: bytes) -> bytes:
+    return (
+        f"HTTP/1.1 {status}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    ).encode() + body
+
+
+def _stream_headers(origin: str) -> bytes:
+    return (
+        "HTTP/1.1 200 OK\r\n"
+        "Content-Type: text/event-stream\r\n"
+        "Cache-Control: no-cache\r\n"
+        "X-Accel-Buffering: no\r\n"
+        f"access-control-allow-origin: {origin}\r\n"
+        "access-control-allow-credentials: true\r\n"
+        "Connection: close\r\n\r\n"
+        f"retry: {RETRY_MS}\n\n"
+    ).encode()
+
+
+def _parse_head(head: bytes):
+    request_line, *lines = head.decode("latin-1").split("\r\n")
+    method, target, _ = request_line.split(" ", 2)
+    headers = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    path, _, query = target.partition("?")
+    return method, path, parse_qs(query), headers
+
+
+def _authorize(event: str, query: dict):
+    # until when the subscriber may receive notifications, None for anonymous
+    # subscribers and False for a token that isn't valid ( anymore )
+    token = query.get("token")
+    if not token:
+        return None
+    try:
+        claims = decode_token(token[0])
+    except Exception:
+        return False
+    if (
+        claims is None
+        or claims.get("token_type") != STREAM_TOKEN
+        or claims.get("event") != event
+    ):
+        return False
+    return claims.get("until") or float("inf")
+
+
+async def _handle(hub: Hub, reader, writer):
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HEADER_TIMEOUT)
+        method, path, query, headers = _parse_head(head)
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+        writer.close()
+        return
+    match = _PATH.match(path)
+    if method != "GET" or not match or match[1] not in hub.subscribers:
+        writer.write(_response("404 Not Found", b'{"error": "not found"}'))
+        writer.close()
+        return
+    event = match[1]
+    until = _authorize(event, query)
+    if until is False:
+        # EventSource gives up on a 401, the client fetches a new token
+        writer.write(_response("401 Unauthorized", b'{"error": "refresh"}'))
+        writer.close()
+        return
+    writer.write(_stream_headers(headers.get("origin") or "*"))
+    hub.add(event, writer, until)
+    try:
+        # clients don't send anything else, this returns once they disconnect
+        while await reader.read(1024):
+            pass
+    except ConnectionError:
+        pass
+    finally:
+        hub.drop(event, writer)
+
+
+def _raise_fd_limit():
+    # every subscriber is an open socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def serve():
+    _raise_fd_limit()
+    hub = Hub()
+    loop = asyncio.get_running_loop()
+
+    safe_remove(STREAM_EVENTS_SOCKET)
+    sock = socket(AF_UNIX, SOCK_DGRAM)
+    sock.setsockopt(SOL_SOCKET, SO_RCVBUF, 1024 * 1024)
+    sock.bind(STREAM_EVENTS_SOCKET)
+    await loop.create_datagram_endpoint(lambda: _Updates(hub), sock=sock)
+
+    def handler(reader, writer):
+        return _handle(hub, reader, writer)
+
+    if STREAM_BIND.startswith("unix:"):
+        path = STREAM_BIND[len("unix:") :]
+        safe_remove(path)
+        server = await asyncio.start_unix_server(
+            handler, path, limit=MAX_HEADER_SIZE, backlog=1024
+        )
+    else:
+        host, _, port = STREAM_BIND.rpartition(":")
+        server = await asyncio.start_server(
+            handler, host or None, int(port), limit=MAX_HEADER_SIZE, backlog=1024
+        )
+    print("Streaming on", STREAM_BIND)
+    async with server:
+        await asyncio.gather(server.serve_forever(), hub.heartbeat())
+
+
+def main():
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -46,6 +46,8 @@ class ParsedRequest:
         self.args = dict(_request.args)
         self.headers = _request.headers
         self.json: dict = _request.get_json() or {}
+        # the raw body, for checking signatures over it
+        self.data: bytes = _request.get_data()
         self.method = _request.method
         self.origin = get_origin(_request.headers)
 
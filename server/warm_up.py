@@ -0,0 +1,54 @@
+"""Cache warm-up before a worker accepts traffic
+"""
+# after a deploy or a worker recycle every hot key misses at once and the first
+# requests all end up in postgres together. `run` fills the caches first:
+# the question snapshots, the per-event leaderboards and the cached responses
+# for the event list, event details, leaderboards and notifications.
+# tasks run in order until WARM_UP_BUDGET seconds are used up, a task that
+# doesn't fit is skipped and simply warms up on its first request instead
+from time import perf_counter
+
+from server import leaderboard as ranking
+from server import metrics, questions
+from server.api_handlers import play
+from server.api_handlers.common import get_event_details
+from server.constants import EVENT_NAMES, WARM_UP_BUDGET
+from server.models import db
+from server.response_caching import wait_for_refreshes
+
+
+def tasks():
+    yield "events-list", play.list_events
+    for event in EVENT_NAMES:
+        yield f"{event}-questions", lambda e=event: questions.snapshot(e)
+        yield f"{event}-event-details", lambda e=event: get_event_details(e)
+        yield f"{event}-board", lambda e=event: ranking.with_board(e, len)
+        yield f"{event}-leaderboard", lambda e=event: play.leaderboard(e)
+        yield f"{event}-notifications", lambda e=event: play.notifications(e)
+
+
+def run(budget: float = WARM_UP_BUDGET) -> bool:
+    # has to be called inside an app context,
+    # returns False if anything was skipped or failed
+    start = perf_counter()
+    deadline = start + budget
+    complete = True
+    for name, task in tasks():
+        if perf_counter() >= deadline:
+            print("Warm-up: out of time, skipped", name)
+            metrics.incr("warm_up.skipped")
+            complete = False
+            continue
+        try:
+            task()
+        except Exception as e:
+            print(f"Warm-up: {name} failed:", e)
+            db.session.rollback()
+            metrics.incr("warm_up.failed")
+            complete = False
+    # stale entries are rebuilt in the background, let them finish so a
+    # preloading master doesn't fork in the middle of one
+    if not wait_for_refreshes(max(deadline - perf_counter(), 0)):
+        complete = False
+    metrics.observe("warm_up.duration", perf_counter() - start)
+    return complete